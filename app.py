@@ -1,5 +1,5 @@
 from fastapi import FastAPI, HTTPException, Query, Request, File, UploadFile
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 import json
@@ -14,13 +14,63 @@ import gc
 import shutil
 import uvicorn
 from starlette.background import BackgroundTask
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager, closing, nullcontext
 from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry
-from prometheus_fastapi_instrumentator import Instrumentator
+from prometheus_fastapi_instrumentator import Instrumentator, metrics
 import time
 import platform
-from PyPDF2 import PdfReader
+from PyPDF2 import PdfReader, PdfWriter
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from jinja2 import Environment, meta as jinja_meta
+from functools import lru_cache
+import re
 from fastapi.responses import JSONResponse
+import cProfile
+import pstats
+import io
+import tracemalloc
+import threading
+import contextvars
+import hmac
+import uuid
+import asyncio
+from pathlib import Path
+from starlette.concurrency import run_in_threadpool
+
+import gzip
+import signal
+import sqlite3
+import hashlib
+import anyio.from_thread
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
 
 def setup_logging():
     """Настройка логирования с учетом окружения"""
@@ -87,9 +137,829 @@ memory_usage_gauge = Gauge(
     registry=metrics_registry
 )
 
+pdf_stage_duration = Histogram(
+    'pdf_stage_duration_seconds',
+    'Time spent in each stage of PDF generation',
+    ['stage'],
+    buckets=[0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0],
+    registry=metrics_registry
+)
+
+# Ограничение размера данных запроса (для сжатых тел - после распаковки)
+MAX_REQUEST_SIZE = int(os.environ.get('MAX_REQUEST_SIZE', str(50 * 1024 * 1024)))
+SUPPORTED_CONTENT_ENCODINGS = {'gzip'} | ({'zstd'} if zstandard is not None else set())
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Ошибки клиента, которые возвращаются как есть, а не как 500
+PASSTHROUGH_STATUS_CODES = {413, 415, 499, 504}
+
+# Постобработка PDF (линеаризация, сжатие); включается параметром optimize или по умолчанию
+PDF_OPTIMIZE_DEFAULT = os.environ.get('PDF_OPTIMIZE', 'false').lower() == 'true'
+
+pdf_size_bytes = Histogram(
+    'pdf_size_bytes',
+    'Size of generated PDF files before and after post-processing',
+    ['variant'],
+    buckets=[10_000, 50_000, 100_000, 500_000, 1_000_000, 5_000_000, 10_000_000, 50_000_000],
+    registry=metrics_registry
+)
+
+pdf_optimize_failures = Counter(
+    'pdf_optimize_failures',
+    'PDF post-processing failures (the unoptimized PDF is returned)',
+    registry=metrics_registry
+)
+
+# Профилирование отдельных запросов (включается только по токену)
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+PROFILING_HEADER = 'X-Profile-Token'
+PROFILES_DIR = os.environ.get('PROFILES_DIR', os.path.join(os.environ.get('TMPDIR', '/tmp'), 'pdf_profiles'))
+PROFILES_KEEP = int(os.environ.get('PROFILES_KEEP', '20'))
+PROFILE_ARTIFACTS = {
+    'prof': 'application/octet-stream',
+    'txt': 'text/plain; charset=utf-8',
+    'json': 'application/json',
+}
+
+# Активная сессия профилирования текущего запроса
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+class RequestProfile:
+    """Профиль CPU и памяти одного запроса генерации PDF"""
+
+    # tracemalloc глобален для процесса, поэтому одновременно профилируется один запрос
+    _lock = threading.Lock()
+    # Количество следующих запросов, взведённых через /admin/profiling
+    _armed = 0
+
+    def __init__(self, request_id):
+        self.profile_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        self.request_id = request_id
+        self.profiler = cProfile.Profile()
+        self.stages = []
+        self.conversions = []
+        self.started = time.perf_counter()
+        self._snapshot = None
+        self._memory = None
+
+    @classmethod
+    def arm(cls, count):
+        cls._armed = max(0, count)
+
+    @classmethod
+    def start(cls, request, request_id):
+        """Начинает профилирование, если оно запрошено и разрешено, иначе возвращает None"""
+        if not PROFILING_TOKEN:
+            return None
+        token = request.headers.get(PROFILING_HEADER)
+        if token is None and cls._armed <= 0:
+            return None
+        if token is not None and not hmac.compare_digest(token, PROFILING_TOKEN):
+            logger.warning(f"[{request_id}] Invalid profiling token, profiling skipped")
+            return None
+        if not cls._lock.acquire(blocking=False):
+            logger.warning(f"[{request_id}] Another request is being profiled, profiling skipped")
+            return None
+        if token is None:
+            cls._armed -= 1
+        profile = cls(request_id)
+        logger.info(f"[{request_id}] Profiling enabled, profile id: {profile.profile_id}")
+        return profile
+
+    @contextmanager
+    def capture(self):
+        """Включает cProfile в текущем потоке и делает профиль активным для этапов конвейера"""
+        token = current_profile.set(self)
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+            current_profile.reset(token)
+
+    @contextmanager
+    def trace_memory(self):
+        """Трассировка аллокаций на время генерации документа.
+
+        tracemalloc глобален для процесса: пока он включен, аллокации параллельных
+        запросов тоже трассируются и замедляются. Поэтому он включается только после
+        получения слота конвертации, а не на время ожидания в очереди.
+        """
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            self._snapshot = tracemalloc.take_snapshot()
+            self._memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    def add_stage(self, stage, duration):
+        self.stages.append({'stage': stage, 'seconds': round(duration, 6)})
+
+    def add_conversion(self, inputs, duration, user_cpu, system_cpu, returncode):
+        self.conversions.append({
+            'input': inputs,
+            'seconds': round(duration, 6),
+            'child_user_cpu_seconds': user_cpu,
+            'child_system_cpu_seconds': system_cpu,
+            'returncode': returncode,
+        })
+
+    def finish(self):
+        """Сохраняет артефакты профиля; вызывается в пуле потоков"""
+        try:
+            self._save()
+        finally:
+            RequestProfile._lock.release()
+
+    def _save(self):
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        base = os.path.join(PROFILES_DIR, self.profile_id)
+        self.profiler.dump_stats(f"{base}.prof")
+
+        stats_text = io.StringIO()
+        pstats.Stats(self.profiler, stream=stats_text).sort_stats('cumulative').print_stats(50)
+        with open(f"{base}.txt", 'w', encoding='utf-8') as f:
+            f.write(stats_text.getvalue())
+
+        # Если запрос не дошел до генерации, данных о памяти нет
+        memory = None
+        if self._snapshot is not None:
+            current, peak = self._memory
+            snapshot = self._snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            memory = {
+                'current_bytes': current,
+                'peak_bytes': peak,
+                'top_allocations': [
+                    {
+                        'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                        'size_bytes': stat.size,
+                        'count': stat.count,
+                    }
+                    for stat in snapshot.statistics('lineno')[:25]
+                ],
+            }
+        summary = {
+            'profile_id': self.profile_id,
+            'request_id': self.request_id,
+            'total_seconds': round(time.perf_counter() - self.started, 6),
+            'stages': self.stages,
+            'libreoffice': self.conversions,
+            'memory': memory,
+        }
+        with open(f"{base}.json", 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+        self._prune()
+        logger.info(f"[{self.request_id}] Profile saved: {base}.*")
+
+    @staticmethod
+    def _prune():
+        """Удаляет старые профили сверх PROFILES_KEEP"""
+        profile_ids = sorted({os.path.splitext(name)[0] for name in os.listdir(PROFILES_DIR)})
+        for profile_id in profile_ids[:-PROFILES_KEEP or None]:
+            for ext in PROFILE_ARTIFACTS:
+                path = os.path.join(PROFILES_DIR, f"{profile_id}.{ext}")
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+# Отмена запросов при отключении клиента или по истечении дедлайна
+DISCONNECT_POLL_INTERVAL = float(os.environ.get('DISCONNECT_POLL_INTERVAL', '0.5'))
+REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout'
+REQUEST_DEADLINE_HEADER = 'X-Request-Deadline'
+
+requests_cancelled = Counter(
+    'pdf_requests_cancelled',
+    'PDF generation requests aborted before completion',
+    ['reason', 'stage'],
+    registry=metrics_registry
+)
+
+cancelled_work_seconds = Counter(
+    'pdf_cancelled_work_seconds',
+    'Processing time already spent on requests that were aborted',
+    ['reason'],
+    registry=metrics_registry
+)
+
+cancelled_saved_seconds = Counter(
+    'pdf_cancelled_saved_seconds',
+    'Estimated processing time saved by aborting requests early',
+    ['reason'],
+    registry=metrics_registry
+)
+
+conversions_killed = Counter(
+    'pdf_conversions_killed',
+    'LibreOffice processes killed because the request was aborted',
+    registry=metrics_registry
+)
+
+# Токен отмены текущего запроса
+current_cancellation = contextvars.ContextVar('current_cancellation', default=None)
+
+
+class RequestCancelled(Exception):
+    """Запрос прерван: клиент отключился или истек дедлайн"""
+
+    def __init__(self, reason, stage=None):
+        super().__init__(f"Request cancelled ({reason}) at stage {stage}")
+        self.reason = reason
+        self.stage = stage
+
+
+class CancellationToken:
+    """Признак отмены запроса, проверяемый между этапами конвейера и при конвертации"""
+
+    def __init__(self, deadline=None, parent=None):
+        # deadline - момент времени по time.perf_counter()
+        # parent - токен запроса, отмена которого отменяет и этот токен
+        self.parent = parent
+        self.deadline = parent.deadline if deadline is None and parent is not None else deadline
+        self.reason = None
+        self.stage = None
+        self._event = threading.Event()
+
+    def cancel(self, reason):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def expired(self):
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def cancelled(self):
+        if not self._event.is_set():
+            if self.parent is not None and self.parent.cancelled():
+                self.stage = self.parent.stage
+                self.cancel(self.parent.reason)
+            elif self.expired():
+                self.cancel('deadline')
+        return self._event.is_set()
+
+    def remaining(self):
+        return None if self.deadline is None else max(0.0, self.deadline - time.perf_counter())
+
+    def check(self, stage=None):
+        if stage is not None:
+            self.stage = stage
+        if self.cancelled():
+            raise RequestCancelled(self.reason, self.stage)
+
+
+def request_deadline(request: Request):
+    """Дедлайн из заголовков: X-Request-Timeout (секунды от начала запроса)
+    или X-Request-Deadline (Unix timestamp)"""
+    start = getattr(request.state, 'request_start', None) or time.perf_counter()
+    try:
+        if REQUEST_TIMEOUT_HEADER in request.headers:
+            return start + float(request.headers[REQUEST_TIMEOUT_HEADER])
+        if REQUEST_DEADLINE_HEADER in request.headers:
+            return time.perf_counter() + float(request.headers[REQUEST_DEADLINE_HEADER]) - time.time()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid request deadline header")
+    return None
+
+def run_cancellable(cancellation, func, *args):
+    """Вызов функции в рабочем потоке с токеном отмены запроса"""
+    token = current_cancellation.set(cancellation)
+    try:
+        return func(*args)
+    finally:
+        current_cancellation.reset(token)
+
+async def watch_request(request: Request, cancellation, work, interruptible):
+    """Отменяет работу, если клиент отключился или истек дедлайн.
+
+    Задачу можно отменить только пока interruptible() (заявка ждет в очереди).
+    Рабочий поток отменой задачи не останавливается, поэтому после получения
+    слота выставляется только токен: поток сам завершится с RequestCancelled
+    на ближайшей проверке этапа или опросе процесса LibreOffice, и лишь затем
+    будут освобождены слот и временные файлы.
+    """
+    while not work.done():
+        if cancellation.expired():
+            cancellation.cancel('deadline')
+        elif await request.is_disconnected():
+            cancellation.cancel('disconnect')
+        if cancellation.cancelled():
+            if interruptible():
+                work.cancel()
+            return
+        remaining = cancellation.remaining()
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL if remaining is None else min(DISCONNECT_POLL_INTERVAL, remaining))
+
+
+@contextmanager
+def pipeline_stage(stage):
+    """Замер длительности этапа генерации PDF; перед этапом проверяется отмена запроса"""
+    cancellation = current_cancellation.get()
+    if cancellation is not None:
+        cancellation.check(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        pdf_stage_duration.labels(stage=stage).observe(duration)
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add_stage(stage, duration)
+
+
+def require_profiling_token(request: Request):
+    """Проверка токена для административных эндпоинтов профилирования"""
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    token = request.headers.get(PROFILING_HEADER, '')
+    if not hmac.compare_digest(token, PROFILING_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+
+def parse_limits(value):
+    """Разбор настроек вида 'small=5,medium=30' в словарь"""
+    limits = {}
+    for part in value.split(','):
+        if '=' in part:
+            key, number = part.split('=', 1)
+            limits[key.strip()] = float(number)
+    return limits
+
+# Планировщик слотов конвертации
+CONVERSION_SLOTS = int(os.environ.get('CONVERSION_SLOTS', '2'))
+# Сколько секунд оценки "прощается" заявке за каждую секунду ожидания
+CONVERSION_AGING_RATE = float(os.environ.get('CONVERSION_AGING_RATE', '1.0'))
+# Верхние границы оценки (в секундах) для классов заявок, всё что выше - large
+CONVERSION_CLASS_BOUNDS = parse_limits(os.environ.get('CONVERSION_CLASS_BOUNDS', 'small=5,medium=30'))
+# Ограничения одновременных конвертаций по классам
+CONVERSION_CLASS_LIMITS = parse_limits(os.environ.get('CONVERSION_CLASS_LIMITS', 'large=1'))
+CONVERSION_CLASSES = list(CONVERSION_CLASS_BOUNDS) + ['large']
+# Каталог профилей LibreOffice для слотов конвертации
+LIBREOFFICE_PROFILE_ROOT = os.environ.get(
+    'LIBREOFFICE_PROFILE_ROOT',
+    os.path.join(os.environ.get('TMPDIR', '/tmp'), 'lo_profiles')
+)
+
+conversion_queue_depth = Gauge(
+    'conversion_queue_depth',
+    'Number of requests waiting for a conversion slot',
+    ['job_class'],
+    registry=metrics_registry
+)
+
+conversion_queue_wait = Histogram(
+    'conversion_queue_wait_seconds',
+    'Time spent waiting for a conversion slot',
+    ['job_class'],
+    buckets=[0.01, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0],
+    registry=metrics_registry
+)
+
+conversions_in_flight = Gauge(
+    'conversions_in_flight',
+    'Number of conversions currently holding a slot',
+    ['job_class'],
+    registry=metrics_registry
+)
+
+
+class ConversionCostModel:
+    """Оценка длительности конвертации: seconds = base + per_row * rows + per_kb * kb.
+
+    Коэффициенты уточняются по наблюдаемым длительностям экспоненциально
+    взвешенным методом наименьших квадратов, регуляризованным к начальным значениям.
+    """
+
+    def __init__(self, base=3.0, per_row=0.002, per_kb=0.0, decay=0.98, ridge=1.0):
+        self.prior = [base, per_row, per_kb]
+        self.coef = list(self.prior)
+        self.decay = decay
+        self.ridge = ridge
+        self._xtx = [[0.0] * 3 for _ in range(3)]
+        self._xty = [0.0] * 3
+        self._lock = threading.Lock()
+
+    def estimate(self, rows, size_bytes):
+        base, per_row, per_kb = self.coef
+        return max(0.0, base + per_row * rows + per_kb * size_bytes / 1024)
+
+    def observe(self, rows, size_bytes, seconds):
+        x = [1.0, float(rows), size_bytes / 1024]
+        with self._lock:
+            for i in range(3):
+                self._xty[i] = self.decay * self._xty[i] + x[i] * seconds
+                for j in range(3):
+                    self._xtx[i][j] = self.decay * self._xtx[i][j] + x[i] * x[j]
+            a = [[self._xtx[i][j] + (self.ridge if i == j else 0.0) for j in range(3)] for i in range(3)]
+            b = [self._xty[i] + self.ridge * self.prior[i] for i in range(3)]
+            self.coef = [max(0.0, c) for c in _solve3(a, b)]
+
+def _solve3(a, b):
+    """Решение системы 3x3 методом Гаусса"""
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(3):
+        pivot = max(range(col, 3), key=lambda r: abs(m[r][col]))
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(col + 1, 3):
+            factor = m[r][col] / m[col][col]
+            for c in range(col, 4):
+                m[r][c] -= factor * m[col][c]
+    x = [0.0] * 3
+    for r in range(2, -1, -1):
+        x[r] = (m[r][3] - sum(m[r][c] * x[c] for c in range(r + 1, 3))) / m[r][r]
+    return x
+
+
+class _ConversionTicket:
+    def __init__(self, estimate, job_class, enqueued, future):
+        self.estimate = estimate
+        self.job_class = job_class
+        self.enqueued = enqueued
+        self.future = future
+
+
+class ConversionScheduler:
+    """Очередь к слотам конвертации: сначала короткие заявки, с учетом старения.
+
+    Приоритет заявки - оценка ее длительности минус aging_rate * время ожидания,
+    поэтому большие заявки со временем обгоняют поток мелких и не голодают.
+    Каждому слоту соответствует свой профиль LibreOffice (converter).
+    """
+
+    def __init__(self, slots, cost_model, aging_rate=1.0, class_bounds=None, class_limits=None):
+        self.cost_model = cost_model
+        self.aging_rate = aging_rate
+        self.class_bounds = class_bounds or {}
+        self.class_limits = class_limits or {}
+        self.slots = slots
+        self._free_converters = list(range(slots))
+        self._waiting = []
+        self._running = {}
+        # Выполняющиеся заявки и время их старта
+        self._active = {}
+
+    def classify(self, estimate):
+        for job_class, bound in sorted(self.class_bounds.items(), key=lambda item: item[1]):
+            if estimate <= bound:
+                return job_class
+        return 'large'
+
+    def _eligible(self, ticket):
+        limit = self.class_limits.get(ticket.job_class)
+        return limit is None or self._running.get(ticket.job_class, 0) < limit
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._free_converters:
+            candidates = [t for t in self._waiting if self._eligible(t)]
+            if not candidates:
+                break
+            ticket = min(candidates, key=lambda t: t.estimate - self.aging_rate * (now - t.enqueued))
+            self._waiting.remove(ticket)
+            conversion_queue_depth.labels(job_class=ticket.job_class).dec()
+            self._running[ticket.job_class] = self._running.get(ticket.job_class, 0) + 1
+            self._active[ticket] = now
+            conversions_in_flight.labels(job_class=ticket.job_class).inc()
+            ticket.future.set_result(self._free_converters.pop(0))
+
+    def _release(self, ticket, converter):
+        self._running[ticket.job_class] -= 1
+        self._active.pop(ticket, None)
+        conversions_in_flight.labels(job_class=ticket.job_class).dec()
+        self._free_converters.append(converter)
+        self._dispatch()
+
+    def queue_depth(self):
+        return len(self._waiting)
+
+    def in_flight(self):
+        return len(self._active)
+
+    def drain_estimate(self):
+        """Оценка времени (в секундах) до освобождения всех слотов при текущей нагрузке"""
+        now = time.monotonic()
+        remaining = sum(max(0.0, t.estimate - (now - started)) for t, started in list(self._active.items()))
+        remaining += sum(t.estimate for t in list(self._waiting))
+        return remaining / max(1, self.slots)
+
+    def load_ratio(self):
+        """Отношение числа заявок (выполняющихся и ожидающих) к числу слотов"""
+        return (len(self._active) + len(self._waiting)) / max(1, self.slots)
+
+    @asynccontextmanager
+    async def slot(self, rows, size_bytes):
+        """Ожидание свободного слота; возвращает номер конвертера"""
+        estimate = self.cost_model.estimate(rows, size_bytes)
+        ticket = _ConversionTicket(
+            estimate,
+            self.classify(estimate),
+            time.monotonic(),
+            asyncio.get_running_loop().create_future()
+        )
+        self._waiting.append(ticket)
+        conversion_queue_depth.labels(job_class=ticket.job_class).inc()
+        self._dispatch()
+        try:
+            converter = await ticket.future
+        except asyncio.CancelledError:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                conversion_queue_depth.labels(job_class=ticket.job_class).dec()
+            elif ticket.future.done() and not ticket.future.cancelled():
+                self._release(ticket, ticket.future.result())
+            raise
+        conversion_queue_wait.labels(job_class=ticket.job_class).observe(time.monotonic() - ticket.enqueued)
+
+        started = time.monotonic()
+        succeeded = False
+        try:
+            yield converter
+            succeeded = True
+        finally:
+            self._release(ticket, converter)
+            if succeeded:
+                self.cost_model.observe(rows, size_bytes, time.monotonic() - started)
+
+
+conversion_scheduler = ConversionScheduler(
+    CONVERSION_SLOTS,
+    ConversionCostModel(),
+    aging_rate=CONVERSION_AGING_RATE,
+    class_bounds=CONVERSION_CLASS_BOUNDS,
+    class_limits=CONVERSION_CLASS_LIMITS,
+)
+for job_class in CONVERSION_CLASSES:
+    conversion_queue_depth.labels(job_class=job_class).set(0)
+    conversions_in_flight.labels(job_class=job_class).set(0)
+
+# Метрики емкости для readiness и HPA вычисляются в момент сбора
+Gauge(
+    'conversion_slots',
+    'Number of conversion slots',
+    registry=metrics_registry
+).set(CONVERSION_SLOTS)
+
+Gauge(
+    'conversion_estimated_drain_seconds',
+    'Estimated time to finish all running and queued conversions',
+    registry=metrics_registry
+).set_function(conversion_scheduler.drain_estimate)
+
+Gauge(
+    'conversion_load_ratio',
+    'Running and queued conversions per conversion slot',
+    registry=metrics_registry
+).set_function(conversion_scheduler.load_ratio)
+
+# Пороги готовности принимать новые запросы
+READINESS_MAX_QUEUE = int(os.environ.get('READINESS_MAX_QUEUE', str(CONVERSION_SLOTS * 2)))
+READINESS_MAX_DRAIN_SECONDS = float(os.environ.get('READINESS_MAX_DRAIN_SECONDS', '120'))
+
+# Архив сгенерированных документов (содержит персональные данные заявителей)
+ARCHIVE_ENABLED = os.environ.get('ARCHIVE_ENABLED', 'false').lower() == 'true'
+# Токен для чтения архива; если не задан, эндпоинты /documents отключены
+ARCHIVE_TOKEN = os.environ.get('ARCHIVE_TOKEN', '')
+ARCHIVE_HEADER = 'X-Archive-Token'
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.environ.get('TMPDIR', '/tmp'), 'pdf_archive'))
+ARCHIVE_RETENTION_DAYS = float(os.environ.get('ARCHIVE_RETENTION_DAYS', '30'))
+ARCHIVE_MAX_BYTES = int(os.environ.get('ARCHIVE_MAX_BYTES', str(1024 * 1024 * 1024)))
+# Сколько версий одной заявки хранить (старые версии вытесняются новой)
+ARCHIVE_KEEP_VERSIONS = int(os.environ.get('ARCHIVE_KEEP_VERSIONS', '1'))
+
+archive_documents_gauge = Gauge(
+    'archive_documents_count',
+    'Number of documents in the archive',
+    registry=metrics_registry
+)
+
+archive_size_gauge = Gauge(
+    'archive_size_bytes',
+    'Total size of archived documents in bytes',
+    registry=metrics_registry
+)
+
+archive_requests = Counter(
+    'archive_requests',
+    'Document archive lookups by result',
+    ['result'],
+    registry=metrics_registry
+)
+
+
+class DocumentArchive:
+    """Локальный архив PDF с индексом в SQLite по id заявки, operation и дате создания"""
+
+    def __init__(self, root, retention_days, max_bytes, keep_versions):
+        self.root = root
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.keep_versions = max(1, keep_versions)
+        self.db_path = os.path.join(root, 'index.sqlite3')
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _init(self):
+        if self._initialized:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    application_id TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    operation TEXT,
+                    creation_date TEXT,
+                    created_at REAL NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    PRIMARY KEY (application_id, version)
+                )
+            ''')
+            # Последний выданный номер версии заявки; не удаляется вместе с документами,
+            # чтобы номера версий не повторялись после очистки по сроку хранения
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS versions (
+                    application_id TEXT PRIMARY KEY,
+                    last_version INTEGER NOT NULL
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS documents_operation ON documents (application_id, operation, version)')
+            connection.execute('CREATE INDEX IF NOT EXISTS documents_creation_date ON documents (creation_date)')
+            connection.execute('CREATE INDEX IF NOT EXISTS documents_created_at ON documents (created_at)')
+        self._initialized = True
+
+    def store(self, application_id, operation, creation_date, pdf_path):
+        """Сохраняет новую версию документа, вытесняя старые; возвращает номер версии"""
+        with self._lock:
+            self._init()
+            directory = os.path.join(self.root, hashlib.sha1(application_id.encode('utf-8')).hexdigest())
+            os.makedirs(directory, exist_ok=True)
+            with closing(self._connect()) as connection, connection:
+                row = connection.execute(
+                    'SELECT MAX(last_version) FROM ('
+                    'SELECT last_version FROM versions WHERE application_id = ? '
+                    'UNION ALL SELECT MAX(version) FROM documents WHERE application_id = ?)',
+                    (application_id, application_id)
+                ).fetchone()
+                version = (row[0] or 0) + 1
+                connection.execute(
+                    'INSERT OR REPLACE INTO versions VALUES (?, ?)', (application_id, version)
+                )
+                path = os.path.join(directory, f'{version}.pdf')
+                # Файл версии появляется целиком
+                shutil.copyfile(pdf_path, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                connection.execute(
+                    'INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (application_id, version, operation, creation_date, time.time(), path, os.path.getsize(path))
+                )
+                # Новая версия инвалидирует предыдущие
+                superseded = connection.execute(
+                    'SELECT version, path FROM documents WHERE application_id = ? ORDER BY version DESC LIMIT -1 OFFSET ?',
+                    (application_id, self.keep_versions)
+                ).fetchall()
+                self._delete(connection, application_id, superseded)
+            self._enforce_policies()
+            return version
+
+    def latest(self, application_id, operation=None):
+        """Последняя версия документа заявки (опционально для заданной operation)"""
+        with self._lock:
+            return self._latest(application_id, operation)
+
+    def open_latest(self, application_id, operation=None):
+        """Последняя версия документа и открытый файл с ней.
+
+        Файл открывается под блокировкой архива, поэтому вытеснение версии
+        одновременным store() или политиками хранения не прерывает его отдачу.
+        """
+        with self._lock:
+            document = self._latest(application_id, operation)
+            if document is None:
+                return None, None
+            try:
+                return document, open(document['path'], 'rb')
+            except FileNotFoundError:
+                return None, None
+
+    def _latest(self, application_id, operation):
+        self._init()
+        query = 'SELECT * FROM documents WHERE application_id = ?'
+        params = [application_id]
+        if operation:
+            query += ' AND operation = ?'
+            params.append(operation)
+        with closing(self._connect()) as connection, connection:
+            row = connection.execute(query + ' ORDER BY version DESC LIMIT 1', params).fetchone()
+            if row is not None and not os.path.exists(row['path']):
+                # Файл удален в обход индекса
+                self._delete(connection, application_id, [row])
+                return None
+            return dict(row) if row is not None else None
+
+    def versions(self, application_id):
+        """Метаданные всех хранимых версий документа заявки"""
+        with self._lock:
+            self._init()
+            with closing(self._connect()) as connection:
+                rows = connection.execute(
+                    'SELECT application_id, version, operation, creation_date, created_at, size '
+                    'FROM documents WHERE application_id = ? ORDER BY version DESC',
+                    (application_id,)
+                ).fetchall()
+                return [dict(row) for row in rows]
+
+    def enforce_policies(self):
+        with self._lock:
+            self._init()
+            self._enforce_policies()
+
+    def _enforce_policies(self):
+        """Удаление документов старше срока хранения и самых старых при превышении размера архива"""
+        with closing(self._connect()) as connection, connection:
+            if self.retention_days > 0:
+                expired = connection.execute(
+                    'SELECT application_id, version, path FROM documents WHERE created_at < ?',
+                    (time.time() - self.retention_days * 86400,)
+                ).fetchall()
+                for row in expired:
+                    self._delete(connection, row['application_id'], [row])
+            if self.max_bytes > 0:
+                total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM documents').fetchone()[0]
+                if total > self.max_bytes:
+                    for row in connection.execute(
+                        'SELECT application_id, version, path, size FROM documents ORDER BY created_at, rowid'
+                    ).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        self._delete(connection, row['application_id'], [row])
+                        total -= row['size']
+        self._update_metrics()
+
+    def _update_metrics(self):
+        with closing(self._connect()) as connection:
+            count, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents').fetchone()
+        archive_documents_gauge.set(count)
+        archive_size_gauge.set(size)
+
+    @staticmethod
+    def _delete(connection, application_id, rows):
+        for row in rows:
+            try:
+                os.remove(row['path'])
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Error removing archived document {row['path']}: {str(e)}")
+            connection.execute(
+                'DELETE FROM documents WHERE application_id = ? AND version = ?',
+                (application_id, row['version'])
+            )
+
+
+document_archive = DocumentArchive(ARCHIVE_DIR, ARCHIVE_RETENTION_DAYS, ARCHIVE_MAX_BYTES, ARCHIVE_KEEP_VERSIONS)
+
+def require_archive_token(request: Request):
+    """Проверка токена для чтения архива: документы содержат персональные данные"""
+    if not ARCHIVE_ENABLED or not ARCHIVE_TOKEN:
+        raise HTTPException(status_code=404, detail="Document archive is disabled")
+    token = request.headers.get(ARCHIVE_HEADER, '')
+    if not hmac.compare_digest(token, ARCHIVE_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid archive token")
+
+def iter_file(file, chunk_size=64 * 1024):
+    """Чтение открытого файла частями с закрытием по окончании"""
+    with file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Проверка наличия и версии LibreOffice при запуске"""
+    if ARCHIVE_ENABLED:
+        try:
+            # Применяем политики хранения к архиву, оставшемуся с прошлого запуска
+            document_archive.enforce_policies()
+        except Exception as e:
+            logger.error(f"Error enforcing archive policies: {str(e)}")
+
+    if INCREMENTAL_ENABLED:
+        try:
+            # Удаляем кеш сегментов заявок, которые давно не обновлялись
+            SegmentCache.prune(INCREMENTAL_CACHE_DIR, INCREMENTAL_RETENTION_DAYS)
+        except Exception as e:
+            logger.error(f"Error pruning segment cache: {str(e)}")
+
     try:
         if platform.system() == 'Windows':
             soffice = r"C:\Program Files\LibreOffice\program\soffice.exe"
@@ -129,42 +999,65 @@ app.add_middleware(GZipMiddleware, minimum_size=1000)
 # Настройка Prometheus метрик
 instrumentator = Instrumentator(
     should_group_status_codes=False,
-    excluded_handlers=["/metrics", "/health"],
+    excluded_handlers=["/metrics", "/health", "/ready"],
     registry=metrics_registry
 )
 
-# Настраиваем метрики
+def observe_request_duration(info):
+    """request_processing_duration по тому же замеру, что и http_request_duration_seconds"""
+    request_processing_duration.observe(info.modified_duration)
+
+# Настраиваем метрики: время запроса измеряется один раз middleware Instrumentator
+instrumentator.add(metrics.default(registry=metrics_registry))
+instrumentator.add(observe_request_duration)
 instrumentator.instrument(app).expose(app, include_in_schema=True, should_gzip=True)
 
-# Добавляем обработчик для метрик времени обработки
-@app.middleware("http")
-async def add_process_time_metric(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    request_processing_duration.observe(process_time)
-    return response
-
-@app.middleware("http")
-async def log_request_info(request: Request, call_next):
-    """Логирование информации о запросе и ошибках"""
-    request_id = f"req_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
-    
-    # Логируем начало запроса
-    logger.info(f"[{request_id}] Started {request.method} {request.url.path}")
-    logger.info(f"[{request_id}] Client IP: {request.client.host}")
-    logger.info(f"[{request_id}] Headers: {dict(request.headers)}")
-    
-    try:
-        response = await call_next(request)
-        logger.info(f"[{request_id}] Completed {response.status_code}")
-        return response
-    except Exception as e:
-        # Детальное логирование ошибки
-        logger.error(f"[{request_id}] Unhandled error processing request: {str(e)}")
-        logger.error(f"[{request_id}] Error type: {type(e).__name__}")
-        logger.error(f"[{request_id}] Error details:", exc_info=True)
-        raise
+class RequestLoggingMiddleware:
+    """Логирование запросов и отметка времени их начала.
+
+    Чистый ASGI middleware: в отличие от @app.middleware("http") не оборачивает
+    запрос и ответ в промежуточные объекты и не буферизует тело.
+    Время начала запроса доступно обработчикам в request.state.request_start.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        scope.setdefault('state', {})['request_start'] = time.perf_counter()
+        request_id = f"req_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+        client = scope.get('client')
+
+        # Логируем начало запроса
+        logger.info(f"[{request_id}] Started {scope['method']} {scope['path']}")
+        logger.info(f"[{request_id}] Client IP: {client[0] if client else None}")
+        if logger.isEnabledFor(logging.DEBUG):
+            headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in scope['headers']}
+            logger.debug(f"[{request_id}] Headers: {headers}")
+
+        status_code = None
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            # Детальное логирование ошибки
+            logger.error(f"[{request_id}] Unhandled error processing request: {str(e)}")
+            logger.error(f"[{request_id}] Error type: {type(e).__name__}")
+            logger.error(f"[{request_id}] Error details:", exc_info=True)
+            raise
+        logger.info(f"[{request_id}] Completed {status_code}")
+
+app.add_middleware(RequestLoggingMiddleware)
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
@@ -200,6 +1093,72 @@ async def global_exception_handler(request: Request, exc: Exception):
         }
     )
 
+def _stream_key(stream):
+    """Ключ для поиска одинаковых потоков: содержимое и словарь без /Length"""
+    digest = hashlib.sha256(stream.read_raw_bytes())
+    for key in sorted(k for k in stream.keys() if k != '/Length'):
+        digest.update(f"{key}={stream[key]!r}".encode('utf-8', 'replace'))
+    return digest.digest()
+
+def deduplicate_images(pdf):
+    """Замена одинаковых изображений в ресурсах страниц ссылкой на один объект"""
+    canonical = {}
+    replaced = 0
+    for page in pdf.pages:
+        resources = page.obj.get('/Resources')
+        xobjects = resources.get('/XObject') if resources is not None else None
+        if xobjects is None:
+            continue
+        for name in list(xobjects.keys()):
+            xobject = xobjects[name]
+            if not isinstance(xobject, pikepdf.Stream) or xobject.get('/Subtype') != '/Image':
+                continue
+            key = _stream_key(xobject)
+            original = canonical.setdefault(key, xobject)
+            if original.objgen != xobject.objgen:
+                xobjects[name] = original
+                replaced += 1
+    return replaced
+
+def optimize_pdf(input_pdf, output_pdf):
+    """Постобработка PDF: дедупликация изображений, сжатие потоков, object streams и линеаризация.
+
+    Шрифты LibreOffice встраивает подмножествами уже при экспорте, поэтому отдельный
+    сабсеттинг не выполняется. Возвращает путь к итоговому файлу; если pikepdf
+    недоступен или постобработка не удалась, возвращается исходный путь.
+    """
+    if pikepdf is None:
+        logger.warning("pikepdf is not installed, PDF post-processing skipped")
+        return input_pdf
+
+    original_size = os.path.getsize(input_pdf)
+    try:
+        with pikepdf.open(input_pdf) as pdf:
+            replaced = deduplicate_images(pdf)
+            pdf.remove_unreferenced_resources()
+            pdf.save(
+                output_pdf,
+                linearize=True,
+                compress_streams=True,
+                recompress_flate=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            )
+    except Exception as e:
+        # Этап необязательный: исходный PDF уже готов
+        pdf_optimize_failures.inc()
+        logger.warning(f"PDF post-processing failed, returning unoptimized PDF: {str(e)}")
+        if os.path.exists(output_pdf):
+            os.remove(output_pdf)
+        return input_pdf
+    optimized_size = os.path.getsize(output_pdf)
+    logger.debug(
+        f"PDF post-processing: {original_size} -> {optimized_size} bytes, "
+        f"{replaced} duplicate images merged"
+    )
+    pdf_size_bytes.labels(variant='original').observe(original_size)
+    pdf_size_bytes.labels(variant='optimized').observe(optimized_size)
+    return output_pdf
+
 def get_pdf_pages(pdf_path):
     """Получение количества страниц в PDF файле с помощью PyPDF2"""
     try:
@@ -212,25 +1171,488 @@ def get_pdf_pages(pdf_path):
         logger.error(f"Error counting PDF pages: {str(e)}")
         return 3  # Возвращаем 3 как значение по умолчанию, если что-то пошло не так
 
-def convert_to_pdf(input_docx, output_pdf):
-    """Конвертация DOCX в PDF с помощью LibreOffice"""
+def kill_process_tree(process):
+    """Завершение процесса LibreOffice вместе с дочерними (soffice.bin)"""
     try:
-        # Определяем путь к soffice в зависимости от ОС
-        if platform.system() == 'Windows':
-            possible_paths = [
-                r"C:\Program Files\LibreOffice\program\soffice.exe",
-                r"C:\Program Files (x86)\LibreOffice\program\soffice.exe"
-            ]
-            soffice = next((path for path in possible_paths if os.path.exists(path)), None)
-            if not soffice:
-                raise Exception("LibreOffice not found in standard locations")
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
         else:
-            soffice = os.environ.get('LIBREOFFICE_PATH', '/usr/bin/soffice')
-        
-        if not os.path.exists(soffice):
-            raise Exception(f"LibreOffice not found at {soffice}")
-            
-        logger.debug(f"Using LibreOffice path: {soffice}")
+            process.kill()
+    except ProcessLookupError:
+        pass
+    process.communicate()
+
+def run_libreoffice(cmd, cwd, env, timeout):
+    """Запуск LibreOffice с таймаутом; при отмене запроса процесс завершается"""
+    cancellation = current_cancellation.get()
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        cwd=cwd,
+        env=env,
+        # Отдельная группа процессов, чтобы при отмене завершить и soffice.bin
+        start_new_session=os.name == 'posix'
+    )
+    started = time.perf_counter()
+    while True:
+        remaining = max(0.0, timeout - (time.perf_counter() - started))
+        try:
+            stdout, stderr = process.communicate(
+                timeout=remaining if cancellation is None else min(remaining, DISCONNECT_POLL_INTERVAL)
+            )
+            return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+        except subprocess.TimeoutExpired:
+            if cancellation is not None and cancellation.cancelled():
+                kill_process_tree(process)
+                conversions_killed.inc()
+                logger.info(f"LibreOffice process {process.pid} killed: request cancelled ({cancellation.reason})")
+                raise RequestCancelled(cancellation.reason, cancellation.stage)
+            if time.perf_counter() - started >= timeout:
+                kill_process_tree(process)
+                raise
+
+def find_soffice():
+    """Путь к soffice в зависимости от ОС"""
+    if platform.system() == 'Windows':
+        possible_paths = [
+            r"C:\Program Files\LibreOffice\program\soffice.exe",
+            r"C:\Program Files (x86)\LibreOffice\program\soffice.exe"
+        ]
+        soffice = next((path for path in possible_paths if os.path.exists(path)), None)
+        if not soffice:
+            raise Exception("LibreOffice not found in standard locations")
+    else:
+        soffice = os.environ.get('LIBREOFFICE_PATH', '/usr/bin/soffice')
+
+    if not os.path.exists(soffice):
+        raise Exception(f"LibreOffice not found at {soffice}")
+    return soffice
+
+def libreoffice_env():
+    """Переменные окружения для процесса LibreOffice"""
+    env = os.environ.copy()
+    env['HOME'] = os.environ.get('HOME', '/home/appuser')
+    env['SAL_USE_VCLPLUGIN'] = 'svp'
+    return env
+
+def libreoffice_profile_dir(converter):
+    """Каталог профиля LibreOffice конвертера"""
+    return os.path.join(LIBREOFFICE_PROFILE_ROOT, f'converter_{converter}')
+
+def run_conversion_attempt(input_docx_list, abs_output_dir, converter, timeout):
+    """Один запуск LibreOffice, конвертирующий все переданные DOCX в PDF в abs_output_dir"""
+    soffice = find_soffice()
+    logger.debug(f"Using LibreOffice path: {soffice}")
+
+    # Команда для конвертации
+    cmd = [
+        soffice,
+        '--headless',
+        '--invisible',
+        '--nodefault',
+        '--nofirststartwizard',
+        '--nolockcheck',
+        '--nologo',
+        '--norestore',
+        '--convert-to',
+        'pdf',
+        '--outdir',
+        abs_output_dir,
+        *[os.path.abspath(path) for path in input_docx_list]
+    ]
+    if converter is not None:
+        profile_dir = libreoffice_profile_dir(converter)
+        cmd.insert(1, f'-env:UserInstallation={Path(profile_dir).absolute().as_uri()}')
+
+    # Запускаем процесс конвертации
+    logger.debug(f"Running command: {' '.join(cmd)}")
+    profile = current_profile.get()
+    if profile is not None:
+        started = time.perf_counter()
+        usage_before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    process = run_libreoffice(cmd, abs_output_dir, libreoffice_env(), timeout=timeout)
+    if profile is not None:
+        # Ресурсы дочерних процессов LibreOffice (soffice -> soffice.bin). RUSAGE_CHILDREN
+        # общий для процесса: при параллельных конвертациях (другие слоты, дубли)
+        # в разницу попадает и их CPU, поэтому значения - верхняя оценка
+        user_cpu = system_cpu = None
+        if usage_before is not None:
+            usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            user_cpu = round(usage_after.ru_utime - usage_before.ru_utime, 6)
+            system_cpu = round(usage_after.ru_stime - usage_before.ru_stime, 6)
+        profile.add_conversion(
+            ', '.join(os.path.basename(path) for path in input_docx_list),
+            time.perf_counter() - started, user_cpu, system_cpu, process.returncode
+        )
+
+    # Проверяем вывод процесса
+    if process.stdout:
+        logger.debug(f"LibreOffice stdout: {process.stdout}")
+    if process.stderr:
+        logger.debug(f"LibreOffice stderr: {process.stderr}")
+
+    if process.returncode != 0:
+        raise ConversionFailed(
+            f"LibreOffice conversion failed with return code {process.returncode}: {process.stderr}",
+            'error'
+        )
+
+# Надзор за конвертациями: хеджирование медленных запусков, повтор и автоматический выключатель
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', 'true').lower() == 'true'
+# Квантиль длительности конвертаций того же размера, после которого запускается дубль
+HEDGE_QUANTILE = float(os.environ.get('HEDGE_QUANTILE', '0.95'))
+# Быстрые конвертации не хеджируются
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', '2'))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', '20'))
+# Сколько дублей может выполняться одновременно сверх слотов конвертации
+HEDGE_MAX_IN_FLIGHT = int(os.environ.get('HEDGE_MAX_IN_FLIGHT', '1'))
+CONVERSION_RETRIES = int(os.environ.get('CONVERSION_RETRIES', '1'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', '30'))
+
+conversion_hedges = Counter(
+    'conversion_hedges',
+    'Hedged conversions by outcome',
+    ['result'],
+    registry=metrics_registry
+)
+
+conversion_retries = Counter(
+    'conversion_retries',
+    'Conversion retries on a fresh LibreOffice instance by outcome',
+    ['result'],
+    registry=metrics_registry
+)
+
+conversion_attempt_failures = Counter(
+    'conversion_attempt_failures',
+    'Failed LibreOffice runs by reason',
+    ['reason'],
+    registry=metrics_registry
+)
+
+conversion_circuit_state = Gauge(
+    'conversion_circuit_state',
+    'Conversion circuit breaker state (0 - closed, 1 - half-open, 2 - open)',
+    registry=metrics_registry
+)
+
+conversion_circuit_rejections = Counter(
+    'conversion_circuit_rejections',
+    'Conversions rejected while the circuit breaker is open',
+    registry=metrics_registry
+)
+
+
+class ConversionFailed(Exception):
+    """Сбой запуска LibreOffice, после которого конвертацию имеет смысл повторить"""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+class ConverterUnavailable(Exception):
+    """Автоматический выключатель разомкнут: конвертации временно не выполняются"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"PDF converter is temporarily unavailable, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Автоматический выключатель конвертаций.
+
+    После failure_threshold неудачных конвертаций подряд размыкается и на
+    reset_seconds отклоняет конвертации сразу. Затем пропускает одну пробную
+    конвертацию: успех замыкает выключатель, сбой снова размыкает.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened = None
+        self._probe = False
+        self._lock = threading.Lock()
+        conversion_circuit_state.set(0)
+
+    @property
+    def enabled(self):
+        return self.failure_threshold > 0
+
+    @property
+    def state(self):
+        if not self.enabled or self._opened is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened >= self.reset_seconds:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def retry_after(self):
+        if self._opened is None:
+            return 0.0
+        return max(1.0, self.reset_seconds - (time.monotonic() - self._opened))
+
+    def check(self):
+        """Отклоняет запрос, не дожидаясь очереди, пока выключатель разомкнут"""
+        if self.state == self.OPEN:
+            conversion_circuit_rejections.inc()
+            raise ConverterUnavailable(self.retry_after())
+
+    def acquire(self):
+        """Разрешение на конвертацию; в полуоткрытом состоянии - только одна пробная"""
+        if not self.enabled:
+            return
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._probe:
+                self._probe = True
+                conversion_circuit_state.set(self._STATE_VALUES[self.HALF_OPEN])
+                return
+        conversion_circuit_rejections.inc()
+        raise ConverterUnavailable(self.retry_after())
+
+    def record_success(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._opened is not None:
+                logger.info("Conversion circuit closed")
+            self._failures = 0
+            self._opened = None
+            self._probe = False
+            conversion_circuit_state.set(self._STATE_VALUES[self.CLOSED])
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._failures += 1
+            if self._probe or (self._opened is None and self._failures >= self.failure_threshold):
+                logger.error(
+                    f"Conversion circuit opened after {self._failures} failed conversions, "
+                    f"rejecting conversions for {self.reset_seconds:.0f}s"
+                )
+                self._opened = time.monotonic()
+                self._probe = False
+                conversion_circuit_state.set(self._STATE_VALUES[self.OPEN])
+
+    def record_cancelled(self):
+        # Отмененная пробная конвертация ничего не говорит о состоянии LibreOffice
+        with self._lock:
+            self._probe = False
+
+
+class ConversionLatency:
+    """Скользящее окно длительностей успешных конвертаций по классам размера входных DOCX"""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def size_class(size_bytes):
+        # Классы размера растут вдвое: до 1 КБ, до 2 КБ, до 4 КБ и т.д.
+        return int(size_bytes // 1024).bit_length()
+
+    def observe(self, size_bytes, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(self.size_class(size_bytes), deque(maxlen=self.window))
+            samples.append(seconds)
+
+    def quantile(self, size_bytes, q, min_samples):
+        """Квантиль длительности или None, если наблюдений пока мало"""
+        with self._lock:
+            samples = sorted(self._samples.get(self.size_class(size_bytes), ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class ConversionSupervisor:
+    """Запуск конвертаций с хеджированием, повтором и автоматическим выключателем.
+
+    Если конвертация идет дольше квантиля HEDGE_QUANTILE для файлов того же
+    размера, запускается дубль на отдельном профиле LibreOffice; результат
+    берется у первого завершившегося, второй процесс завершается. Сбой запуска
+    LibreOffice повторяется один раз на новом экземпляре (профиль пересоздается).
+    Каждая попытка пишет в свою директорию, результат победителя переносится
+    в выходную директорию.
+    """
+
+    def __init__(self, breaker, latency, scheduler=None, retries=1, hedge_enabled=True,
+                 hedge_quantile=0.95, hedge_min_delay=2.0, hedge_min_samples=20, hedge_max_in_flight=1):
+        self.breaker = breaker
+        self.latency = latency
+        self.scheduler = scheduler
+        self.retries = retries
+        self.hedge_enabled = hedge_enabled and hedge_max_in_flight > 0
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._hedge_slots = threading.BoundedSemaphore(max(1, hedge_max_in_flight))
+        self._executor = ThreadPoolExecutor(thread_name_prefix='conversion')
+
+    def run(self, input_docx_list, abs_output_dir, converter, timeout):
+        self.breaker.acquire()
+        try:
+            self._run_with_retry(input_docx_list, abs_output_dir, converter, timeout)
+        except RequestCancelled:
+            self.breaker.record_cancelled()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+
+    def _run_with_retry(self, input_docx_list, abs_output_dir, converter, timeout):
+        for attempt in range(self.retries + 1):
+            try:
+                self._run_hedged(input_docx_list, abs_output_dir, converter, timeout)
+            except (ConversionFailed, subprocess.TimeoutExpired) as e:
+                if attempt == self.retries:
+                    if attempt > 0:
+                        conversion_retries.labels(result='failed').inc()
+                    raise
+                logger.warning(f"Conversion on converter {converter} failed, retrying on a fresh instance: {str(e)}")
+                # Профиль мог быть поврежден упавшим процессом
+                for name in (converter, f'hedge_{converter}'):
+                    if name is not None:
+                        shutil.rmtree(libreoffice_profile_dir(name), ignore_errors=True)
+                continue
+            if attempt > 0:
+                conversion_retries.labels(result='succeeded').inc()
+            return
+
+    def _attempt(self, input_docx_list, output_dir, converter, timeout, cancellation):
+        token = current_cancellation.set(cancellation)
+        try:
+            run_conversion_attempt(input_docx_list, output_dir, converter, timeout)
+        except subprocess.TimeoutExpired:
+            conversion_attempt_failures.labels(reason='timeout').inc()
+            raise
+        except ConversionFailed as e:
+            conversion_attempt_failures.labels(reason=e.reason).inc()
+            raise
+        finally:
+            current_cancellation.reset(token)
+        for path in input_docx_list:
+            pdf_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + '.pdf')
+            if not os.path.exists(pdf_path) or os.path.getsize(pdf_path) == 0:
+                conversion_attempt_failures.labels(reason='no_output').inc()
+                raise ConversionFailed(f"PDF file was not created: {pdf_path}", 'no_output')
+
+    def _submit(self, attempts, input_docx_list, abs_output_dir, converter, timeout, role):
+        output_dir = tempfile.mkdtemp(prefix=f'{role}_', dir=abs_output_dir)
+        cancellation = CancellationToken(parent=current_cancellation.get())
+        # Профиль запроса и прочие contextvars доступны в потоке попытки
+        context = contextvars.copy_context()
+        future = self._executor.submit(
+            context.run, self._attempt, input_docx_list, output_dir, converter, timeout, cancellation
+        )
+        attempts[future] = (output_dir, cancellation, role)
+        return future
+
+    def _hedge_delay(self, size_bytes):
+        if not self.hedge_enabled:
+            return None
+        delay = self.latency.quantile(size_bytes, self.hedge_quantile, self.hedge_min_samples)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+    def _start_hedge(self, attempts, input_docx_list, abs_output_dir, converter, timeout):
+        # Дубль не запускается, если заявки уже ждут слот конвертации
+        if self.scheduler is not None and self.scheduler.queue_depth() > 0:
+            return False
+        if not self._hedge_slots.acquire(blocking=False):
+            return False
+        future = self._submit(attempts, input_docx_list, abs_output_dir, f'hedge_{converter}', timeout, 'hedge')
+        future.add_done_callback(lambda _: self._hedge_slots.release())
+        conversion_hedges.labels(result='started').inc()
+        logger.info(f"Conversion on converter {converter} exceeded p{self.hedge_quantile * 100:.0f}, started hedge")
+        return True
+
+    def _run_hedged(self, input_docx_list, abs_output_dir, converter, timeout):
+        size_bytes = sum(os.path.getsize(path) for path in input_docx_list if os.path.exists(path))
+        delay = self._hedge_delay(size_bytes)
+        started = time.perf_counter()
+        attempts = {}
+        hedged = False
+        self._submit(attempts, input_docx_list, abs_output_dir, converter, timeout, 'primary')
+        try:
+            while True:
+                wait_timeout = None if hedged or delay is None else max(0.0, started + delay - time.perf_counter())
+                done, _ = wait_futures(list(attempts), timeout=wait_timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    hedged = self._start_hedge(attempts, input_docx_list, abs_output_dir, converter, timeout)
+                    # Если дубль запустить нельзя, просто ждем основную попытку
+                    delay = None
+                    continue
+                for future in done:
+                    output_dir, _, role = attempts.pop(future)
+                    try:
+                        future.result()
+                    except Exception:
+                        shutil.rmtree(output_dir, ignore_errors=True)
+                        if attempts and not isinstance(future.exception(), RequestCancelled):
+                            # Ждем оставшуюся попытку
+                            continue
+                        if hedged:
+                            conversion_hedges.labels(result='failed').inc()
+                        raise
+                    for path in input_docx_list:
+                        name = os.path.splitext(os.path.basename(path))[0] + '.pdf'
+                        os.replace(os.path.join(output_dir, name), os.path.join(abs_output_dir, name))
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    if hedged:
+                        conversion_hedges.labels(result=f'{role}_won').inc()
+                    self.latency.observe(size_bytes, time.perf_counter() - started)
+                    return
+        finally:
+            # Дожидаемся остановки проигравшей попытки: следующая конвертация на этом слоте
+            # запустит soffice с тем же профилем, и LibreOffice передал бы задание
+            # завершающемуся процессу
+            for _, cancellation, _ in attempts.values():
+                cancellation.cancel('hedge')
+            if attempts:
+                wait_futures(list(attempts))
+            for output_dir, _, _ in attempts.values():
+                shutil.rmtree(output_dir, ignore_errors=True)
+
+
+conversion_supervisor = ConversionSupervisor(
+    CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS),
+    ConversionLatency(),
+    scheduler=conversion_scheduler,
+    retries=CONVERSION_RETRIES,
+    hedge_enabled=HEDGE_ENABLED,
+    hedge_quantile=HEDGE_QUANTILE,
+    hedge_min_delay=HEDGE_MIN_DELAY,
+    hedge_min_samples=HEDGE_MIN_SAMPLES,
+    hedge_max_in_flight=HEDGE_MAX_IN_FLIGHT,
+)
+
+def run_conversion(input_docx_list, abs_output_dir, converter, timeout):
+    """Конвертация DOCX в PDF в abs_output_dir под надзором conversion_supervisor"""
+    conversion_supervisor.run(input_docx_list, abs_output_dir, converter, timeout)
+
+def convert_to_pdf(input_docx, output_pdf, converter=None):
+    """Конвертация DOCX в PDF с помощью LibreOffice.
+
+    converter - номер слота планировщика; для каждого слота используется свой
+    профиль LibreOffice, чтобы параллельные процессы soffice не конфликтовали.
+    """
+    output_dir = os.path.dirname(output_pdf)
+    env = libreoffice_env()
+    try:
         logger.debug(f"Input DOCX: {input_docx}")
         logger.debug(f"Output PDF: {output_pdf}")
         
@@ -239,55 +1661,13 @@ def convert_to_pdf(input_docx, output_pdf):
             raise Exception(f"Input DOCX file not found: {input_docx}")
             
         # Проверяем права на запись в выходную директорию
-        output_dir = os.path.dirname(output_pdf)
         if not os.access(output_dir, os.W_OK):
             raise Exception(f"No write permission in output directory: {output_dir}")
         
         # Используем абсолютные пути
-        abs_input_docx = os.path.abspath(input_docx)
         abs_output_dir = os.path.abspath(output_dir)
         
-        # Команда для конвертации
-        cmd = [
-            soffice,
-            '--headless',
-            '--invisible',
-            '--nodefault',
-            '--nofirststartwizard',
-            '--nolockcheck',
-            '--nologo',
-            '--norestore',
-            '--convert-to',
-            'pdf',
-            '--outdir',
-            abs_output_dir,
-            abs_input_docx
-        ]
-        
-        # Устанавливаем переменные окружения для процесса
-        env = os.environ.copy()
-        env['HOME'] = os.environ.get('HOME', '/home/appuser')
-        env['SAL_USE_VCLPLUGIN'] = 'svp'
-        
-        # Запускаем процесс конвертации
-        logger.debug(f"Running command: {' '.join(cmd)}")
-        process = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            cwd=abs_output_dir,
-            env=env,
-            timeout=60  # Таймаут 60 секунд
-        )
-        
-        # Проверяем вывод процесса
-        if process.stdout:
-            logger.debug(f"LibreOffice stdout: {process.stdout}")
-        if process.stderr:
-            logger.debug(f"LibreOffice stderr: {process.stderr}")
-            
-        if process.returncode != 0:
-            raise Exception(f"LibreOffice conversion failed with return code {process.returncode}: {process.stderr}")
+        run_conversion([input_docx], abs_output_dir, converter, timeout=60)  # Таймаут 60 секунд
             
         # Ищем созданный PDF файл
         expected_pdf = os.path.join(abs_output_dir, os.path.splitext(os.path.basename(input_docx))[0] + '.pdf')
@@ -314,6 +1694,8 @@ def convert_to_pdf(input_docx, output_pdf):
         if os.path.getsize(output_pdf) == 0:
             raise Exception(f"Generated PDF file is empty: {output_pdf}")
             
+    except (RequestCancelled, ConverterUnavailable):
+        raise
     except subprocess.TimeoutExpired:
         raise Exception("LibreOffice conversion timed out after 60 seconds")
     except Exception as e:
@@ -391,204 +1773,859 @@ def process_registry_items(items):
                 gc.collect()
     return table_rows
 
+def prepare_template_data(json_data, request_id):
+    """Подготовка контекста шаблона из данных заявки"""
+    table_data = json_data.copy()  # Создаем копию для модификации
+
+    # Обрабатываем данные заявителя в зависимости от типа
+    logger.debug(f"[{request_id}] Applicant type: {json_data.get('applicantType')}")
+
+    if json_data.get('applicantType') == 'ORGANIZATION':
+        if json_data.get('organizationInfo'):
+            # Для организации используем полные данные
+            table_data['applicant_info'] = (
+                f"{json_data['organizationInfo'].get('name', '')}, "
+                f"{json_data['organizationInfo'].get('address', '')}, "
+                f"{json_data['organizationInfo'].get('agent', '')}"
+            )
+            table_data['applicant_name'] = json_data['organizationInfo'].get('name', '')
+            table_data['applicant_agent'] = json_data['organizationInfo'].get('agent', '')
+            table_data['is_organization'] = True
+        else:
+            table_data['applicant_info'] = ''
+            table_data['applicant_name'] = ''
+            table_data['applicant_agent'] = ''
+            table_data['is_organization'] = True
+    else:  # INDIVIDUAL
+        if json_data.get('individualInfo'):
+            # Для физ. лица добавляем ЕСИА номер
+            esia_number = json_data['individualInfo'].get('esia', '')
+            esia_suffix = f" (ЕСИА {esia_number})" if esia_number else ''
+            name = json_data['individualInfo'].get('name', '')
+
+            table_data['applicant_info'] = f"{name}{esia_suffix}"
+            table_data['applicant_name'] = f"физическое лицо {name}"
+            table_data['applicant_agent'] = ''  # Для физ. лица поле представителя оставляем пустым
+            table_data['is_organization'] = False
+        else:
+            table_data['applicant_info'] = ''
+            table_data['applicant_name'] = ''
+            table_data['applicant_agent'] = ''
+            table_data['is_organization'] = False
+
+    logger.debug(f"[{request_id}] Prepared applicant data: {table_data['applicant_info']}")
+
+    # Подготавливаем данные для таблицы с оптимизацией памяти
+    if 'registryItems' in json_data:
+        with pipeline_stage('process_registry_items'):
+            table_data['table_rows'] = process_registry_items(json_data['registryItems'])
+
+    # Форматируем дату
+    if 'creationDate' in json_data:
+        try:
+            # Предполагаем, что дата приходит в формате ISO
+            date_obj = datetime.fromisoformat(json_data['creationDate'].replace('Z', '+00:00'))
+            table_data['creationDate'] = date_obj.strftime("%d.%m.%Y")
+            logger.debug(f"[{request_id}] Formatted date: {table_data['creationDate']}")
+        except Exception as e:
+            logger.error(f"[{request_id}] Error formatting date: {e}")
+
+    return table_data
+
+def render_docx(template_path, table_data, docx_path, request_id):
+    """Рендеринг шаблона и сохранение DOCX"""
+    doc = DocxTemplate(template_path)
+    with pipeline_stage('render'):
+        try:
+            doc.render(table_data)
+            logger.debug(f"[{request_id}] Template rendered successfully")
+            # Очищаем память после рендеринга
+            gc.collect()
+        except Exception as e:
+            logger.error(f"[{request_id}] Template rendering failed: {str(e)}")
+            logger.error(f"[{request_id}] Template context too large to log")
+            raise
+
+    logger.debug(f"[{request_id}] Saving DOCX to: {docx_path}")
+    with pipeline_stage('save_docx'):
+        doc.save(docx_path)
+
+TEMPLATE_PATH = "templates/template.docx"
+
+# Инкрементальная перегенерация больших реестров по сегментам
+# Включается явно: в таком документе каждый сегмент начинается с новой страницы
+INCREMENTAL_ENABLED = os.environ.get('INCREMENTAL_ENABLED', 'false').lower() == 'true'
+# Минимальный размер реестра, с которого документ собирается из сегментов
+INCREMENTAL_MIN_ROWS = int(os.environ.get('INCREMENTAL_MIN_ROWS', '1000'))
+INCREMENTAL_SEGMENT_ROWS = int(os.environ.get('INCREMENTAL_SEGMENT_ROWS', '200'))
+INCREMENTAL_CACHE_DIR = os.environ.get(
+    'INCREMENTAL_CACHE_DIR',
+    os.path.join(os.environ.get('TMPDIR', '/tmp'), 'pdf_segments')
+)
+# Максимальное число проходов уточнения нумерации страниц сегментов
+INCREMENTAL_MAX_PASSES = 3
+INCREMENTAL_RETENTION_DAYS = float(os.environ.get('INCREMENTAL_RETENTION_DAYS', '30'))
+
+incremental_segments = Counter(
+    'pdf_incremental_segments',
+    'Registry segments in incremental builds by result',
+    ['result'],
+    registry=metrics_registry
+)
+
+
+def split_template_body(body):
+    """Индексы абзаца с разрывом страницы после титульного листа и таблицы реестра.
+
+    Возвращает None, если шаблон нельзя разбить на титульный лист и перечень.
+    """
+    children = [el for el in body if el.tag != qn('w:sectPr')]
+    table_index = next((i for i, el in enumerate(children) if el.tag == qn('w:tbl')), None)
+    if table_index is None:
+        return None
+    page_break_index = None
+    for i in range(table_index):
+        if any(br.get(qn('w:type')) == 'page' for br in children[i].iter(qn('w:br'))):
+            page_break_index = i
+    if page_break_index is None:
+        return None
+    return page_break_index, table_index
+
+
+class SegmentTemplate(DocxTemplate):
+    """Часть шаблона: титульный лист ('cover') или сегмент таблицы реестра ('segment').
+
+    Первый сегмент включает шапку перечня, последний - окончание документа.
+    Номера строк реестра сдвигаются на index_offset, нумерация страниц
+    начинается с first_page.
+    """
+
+    def __init__(self, template_path, part, first=False, last=False, index_offset=0, first_page=1):
+        super().__init__(template_path)
+        self.index_offset = index_offset
+        self.init_docx()
+        body = self.docx.element.body
+        children = [el for el in body if el.tag != qn('w:sectPr')]
+        page_break_index, table_index = split_template_body(body)
+        if part == 'cover':
+            keep = children[:page_break_index + 1]
+        else:
+            keep = children[table_index:table_index + 1]
+            if first:
+                keep = children[page_break_index + 1:table_index] + keep
+            if last:
+                keep = keep + children[table_index + 1:]
+        keep_ids = {id(el) for el in keep}
+        for el in children:
+            if id(el) not in keep_ids:
+                body.remove(el)
+        if part == 'cover':
+            for br in list(body.iter(qn('w:br'))):
+                if br.get(qn('w:type')) == 'page':
+                    br.getparent().remove(br)
+
+        # Нумерация страниц продолжается с first_page
+        sect_pr = body.find(qn('w:sectPr'))
+        pg_num_type = sect_pr.find(qn('w:pgNumType'))
+        if pg_num_type is None:
+            pg_num_type = OxmlElement('w:pgNumType')
+            cols = sect_pr.find(qn('w:cols'))
+            if cols is not None:
+                cols.addprevious(pg_num_type)
+            else:
+                sect_pr.append(pg_num_type)
+        pg_num_type.set(qn('w:start'), str(first_page))
+
+    def patch_xml(self, src_xml):
+        xml = super().patch_xml(src_xml)
+        if self.index_offset:
+            xml = re.sub(r'\bloop\.index\b', f'(loop.index + {self.index_offset})', xml)
+        return xml
+
+    def variables(self):
+        """Переменные контекста, используемые частью шаблона (включая колонтитулы)"""
+        sources = [self.patch_xml(self.get_xml())]
+        for uri in (self.HEADER_URI, self.FOOTER_URI):
+            for _, part in self.get_headers_footers(uri):
+                sources.append(self.patch_xml(self.get_part_xml(part)))
+        environment = Environment()
+        names = set()
+        for source in sources:
+            names |= jinja_meta.find_undeclared_variables(environment.parse(source))
+        return names
+
+
+@lru_cache(maxsize=8)
+def template_segmentable(template_path, mtime):
+    """Можно ли собирать документ из сегментов для данного шаблона"""
+    return split_template_body(DocxTemplate(template_path).get_docx().element.body) is not None
+
+@lru_cache(maxsize=8)
+def segment_variables(template_path, mtime):
+    """Переменные, от которых зависят страницы реестра (кроме самих строк)"""
+    names = SegmentTemplate(template_path, 'segment', first=True, last=True).variables()
+    return sorted(names - {'registryItems', 'table_rows', 'registry_pages'})
+
+@lru_cache(maxsize=8)
+def template_digest(template_path, mtime):
+    """Хеш содержимого шаблона: сегменты старого шаблона не используются с новым"""
+    with open(template_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def incremental_applicable(json_data, template_path=None):
+    """Собирать ли документ из сегментов: большой реестр и известный id заявки"""
+    template_path = template_path or TEMPLATE_PATH
+    if not INCREMENTAL_ENABLED or not isinstance(json_data, dict) or not json_data.get('id'):
+        return False
+    items = json_data.get('registryItems')
+    if not isinstance(items, list) or len(items) < INCREMENTAL_MIN_ROWS:
+        return False
+    try:
+        return template_segmentable(template_path, os.path.getmtime(template_path))
+    except Exception as e:
+        logger.error(f"Error inspecting template for incremental build: {str(e)}")
+        return False
+
+
+class SegmentCache:
+    """PDF сегменты последней версии заявки, ключ - хеш содержимого сегмента"""
+
+    _locks = {}
+    _locks_guard = threading.Lock()
+
+    def __init__(self, root, application_id):
+        self.directory = os.path.join(root, hashlib.sha1(application_id.encode('utf-8')).hexdigest())
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        with self._locks_guard:
+            self.lock = self._locks.setdefault(self.directory, threading.Lock())
+        self._pages = {}
+
+    @contextmanager
+    def locked(self):
+        """Блокировка кеша заявки между потоками и между процессами (bulk_generate)"""
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.pdf')
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def pages(self, key):
+        if key not in self._pages:
+            self._pages[key] = len(PdfReader(self.path(key)).pages)
+        return self._pages[key]
+
+    def previous_pages(self):
+        """Количество страниц сегментов предыдущей версии по их позициям"""
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return [segment['pages'] for segment in json.load(f)['segments']]
+        except (FileNotFoundError, ValueError, KeyError):
+            return []
+
+    def store(self, key, pdf_path):
+        os.makedirs(self.directory, exist_ok=True)
+        shutil.move(pdf_path, self.path(key))
+
+    def commit(self, keys):
+        """Сохраняет состав текущей версии и удаляет сегменты, которые в нее не вошли"""
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({'segments': [{'key': key, 'pages': self.pages(key)} for key in keys]}, f)
+        current = {f'{key}.pdf' for key in keys}
+        for name in os.listdir(self.directory):
+            if name.endswith('.pdf') and name not in current:
+                os.remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def prune(root, retention_days):
+        """Удаляет кеш заявок, не обновлявшихся дольше retention_days"""
+        if retention_days <= 0 or not os.path.isdir(root):
+            return
+        threshold = time.time() - retention_days * 86400
+        for name in os.listdir(root):
+            directory = os.path.join(root, name)
+            manifest_path = os.path.join(directory, 'manifest.json')
+            # Без манифеста (первая сборка еще идет) ориентируемся на время создания директории
+            updated = os.path.getmtime(manifest_path if os.path.exists(manifest_path) else directory)
+            if updated < threshold:
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+def segment_key(template, rows, context, first, last, index_offset, first_page):
+    """Хеш всего, что влияет на страницы сегмента"""
+    payload = json.dumps(
+        [template, rows, context, first, last, index_offset, first_page],
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def convert_parts(docx_paths, output_dir, converter):
+    """Конвертация нескольких частей документа одним запуском LibreOffice"""
+    run_conversion(docx_paths, os.path.abspath(output_dir), converter, timeout=60 + 10 * len(docx_paths))
+    pdf_paths = [os.path.splitext(path)[0] + '.pdf' for path in docx_paths]
+    for path in pdf_paths:
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            raise Exception(f"PDF file was not created: {path}")
+    return pdf_paths
+
+def build_pdf_incremental(json_data, temp_dir, request_id, converter=None):
+    """Сборка PDF из титульного листа и сегментов реестра.
+
+    Сегменты предыдущей версии заявки с тем же содержимым, контекстом, номерами
+    строк и страниц берутся из кеша; конвертируются только измененные сегменты
+    (одним запуском LibreOffice) и титульный лист с итоговым registry_pages.
+    """
+    template_path = TEMPLATE_PATH
+    mtime = os.path.getmtime(template_path)
+    with pipeline_stage('prepare_data'):
+        table_data = prepare_template_data(json_data, request_id)
+        items = json_data['registryItems']
+        size = max(1, INCREMENTAL_SEGMENT_ROWS)
+        segments = [items[i:i + size] for i in range(0, len(items), size)]
+        context = {name: table_data.get(name) for name in segment_variables(template_path, mtime)}
+        template_version = template_digest(template_path, mtime)
+
+    cache = SegmentCache(INCREMENTAL_CACHE_DIR, str(json_data['id']))
+    with cache.locked():
+        # Номер первой страницы сегмента зависит от числа страниц предыдущих сегментов.
+        # Сначала берем число страниц из предыдущей версии (или 1), конвертируем все
+        # недостающие сегменты и получаем их фактическое число страниц; затем
+        # переконвертируются только сегменты, у которых сдвинулась первая страница.
+        # Число страниц сегмента от номера первой страницы не зависит, поэтому
+        # обычно хватает двух проходов.
+        previous_pages = cache.previous_pages()
+        pages = [previous_pages[i] if i < len(previous_pages) else 1 for i in range(len(segments))]
+        converted = set()
+        for _ in range(INCREMENTAL_MAX_PASSES):
+            plan = []
+            page = 2
+            for i, rows in enumerate(segments):
+                first, last = i == 0, i == len(segments) - 1
+                plan.append((i, segment_key(template_version, rows, context, first, last, i * size, page), page))
+                page += pages[i]
+            missing = [(i, key, first_page) for i, key, first_page in plan if not cache.has(key)]
+            if missing:
+                docx_paths = []
+                for i, key, first_page in missing:
+                    docx_path = os.path.join(temp_dir, f'segment_{i:05d}.docx')
+                    segment_data = dict(
+                        table_data,
+                        registryItems=segments[i],
+                        table_rows=table_data.get('table_rows', [])[i * size:(i + 1) * size]
+                    )
+                    template = SegmentTemplate(
+                        template_path, 'segment',
+                        first=i == 0, last=i == len(segments) - 1,
+                        index_offset=i * size, first_page=first_page
+                    )
+                    with pipeline_stage('render'):
+                        template.render(segment_data)
+                    with pipeline_stage('save_docx'):
+                        template.save(docx_path)
+                    docx_paths.append(docx_path)
+                with pipeline_stage('convert'):
+                    pdf_paths = convert_parts(docx_paths, temp_dir, converter)
+                for (i, key, _), pdf_path in zip(missing, pdf_paths):
+                    cache.store(key, pdf_path)
+                    converted.add(key)
+            actual_pages = [cache.pages(key) for _, key, _ in plan]
+            if actual_pages == pages:
+                break
+            pages = actual_pages
+        else:
+            raise Exception("Segment page numbering did not converge")
+
+        keys = [key for _, key, _ in plan]
+        # Сегменты, сконвертированные с неверной первой страницей, в документ не входят
+        converted_count = len(converted.intersection(keys))
+        incremental_segments.labels(result='converted').inc(converted_count)
+        incremental_segments.labels(result='reused').inc(len(keys) - converted_count)
+        logger.info(
+            f"[{request_id}] Incremental build: {len(keys)} segments, "
+            f"{converted_count} converted, {len(keys) - converted_count} reused, "
+            f"{len(converted)} segment conversions"
+        )
+
+        # Титульный лист рендерится с итоговым количеством страниц реестра
+        table_data['registry_pages'] = sum(cache.pages(key) for key in keys)
+        cover_docx = os.path.join(temp_dir, 'cover.docx')
+        cover = SegmentTemplate(template_path, 'cover')
+        with pipeline_stage('render'):
+            cover.render(table_data)
+        with pipeline_stage('save_docx'):
+            cover.save(cover_docx)
+        with pipeline_stage('convert'):
+            cover_pdf, = convert_parts([cover_docx], temp_dir, converter)
+
+        # Склеиваем титульный лист и сегменты
+        pdf_path = os.path.join(temp_dir, 'output.pdf')
+        with pipeline_stage('splice'):
+            writer = PdfWriter()
+            writer.append(cover_pdf)
+            for key in keys:
+                writer.append(cache.path(key))
+            with open(pdf_path, 'wb') as f:
+                writer.write(f)
+            cache.commit(keys)
+
+    logger.debug(f"[{request_id}] Registry pages: {table_data['registry_pages']}")
+    return pdf_path
+
+def build_pdf(json_data, temp_dir, request_id, converter=None, optimize=False):
+    """Генерация PDF и, если запрошено, постобработка итогового файла.
+
+    Большие реестры собираются из сегментов, остальные документы - полным циклом.
+    """
+    if incremental_applicable(json_data):
+        pdf_path = build_pdf_incremental(json_data, temp_dir, request_id, converter)
+    else:
+        pdf_path = build_pdf_full(json_data, temp_dir, request_id, converter)
+
+    if optimize:
+        with pipeline_stage('optimize'):
+            pdf_path = optimize_pdf(pdf_path, os.path.join(temp_dir, "output.optimized.pdf"))
+
+    return pdf_path
+
+def build_pdf_full(json_data, temp_dir, request_id, converter=None):
+    """Полный цикл генерации PDF: подготовка данных, два рендера, две конвертации"""
+    docx_path = os.path.join(temp_dir, "output.docx")
+    pdf_path = os.path.join(temp_dir, "output.pdf")
+
+    template_path = TEMPLATE_PATH
+    logger.debug(f"[{request_id}] Loading template from: {template_path}")
+
+    with pipeline_stage('prepare_data'):
+        table_data = prepare_template_data(json_data, request_id)
+
+    # Выводим все данные перед рендерингом
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"[{request_id}] Final template data:")
+        logger.debug(json.dumps(prepare_data_for_logging(table_data), indent=2, ensure_ascii=False))
+
+    render_docx(template_path, table_data, docx_path, request_id)
+
+    # Конвертируем в PDF для подсчета страниц
+    with pipeline_stage('convert'):
+        convert_to_pdf(docx_path, pdf_path, converter)
+
+    # Получаем реальное количество страниц в PDF
+    with pipeline_stage('count_pages'):
+        pages = get_pdf_pages(pdf_path)
+    logger.debug(f"[{request_id}] Document has {pages} pages")
+
+    # Обновляем количество страниц в шаблоне
+    table_data['registry_pages'] = pages - 1  # Вычитаем первую страницу
+    logger.debug(f"[{request_id}] Setting registry_pages to {pages - 1}")
+
+    # Рендерим документ заново с обновленным количеством страниц
+    render_docx(template_path, table_data, docx_path, request_id)
+
+    # Конвертируем в PDF финальную версию
+    with pipeline_stage('convert'):
+        convert_to_pdf(docx_path, pdf_path, converter)
+
+    # Проверяем, что количество страниц корректно обновилось
+    if logger.isEnabledFor(logging.DEBUG):
+        with pipeline_stage('count_pages'):
+            final_pages = get_pdf_pages(pdf_path)
+        logger.debug(f"[{request_id}] Final document has {final_pages} pages, registry_pages set to {table_data['registry_pages']}")
+
+    return pdf_path
+
+def parse_json(request_body):
+    """Разбор JSON тела запроса"""
+    with pipeline_stage('parse_json'):
+        return json.loads(request_body)
+
+def run_profiled(profile, func, *args):
+    """Вызов функции под профилировщиком запроса, если он включен"""
+    if profile is None:
+        return func(*args)
+    with profile.capture():
+        return func(*args)
+
+class RequestTooLarge(Exception):
+    """Распакованное тело запроса превышает MAX_REQUEST_SIZE"""
+
+
+class AsyncBodyReader(io.RawIOBase):
+    """Синхронное чтение асинхронного потока тела запроса из рабочего потока"""
+
+    def __init__(self, stream):
+        self._iterator = stream.__aiter__()
+        self._buffer = b''
+        self.raw_bytes = 0
+
+    def readable(self):
+        return True
+
+    async def _next_chunk(self):
+        try:
+            return await self._iterator.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    def readinto(self, b):
+        while not self._buffer:
+            chunk = anyio.from_thread.run(self._next_chunk)
+            if chunk is None:
+                return 0
+            self.raw_bytes += len(chunk)
+            self._buffer = chunk
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class LimitedReader:
+    """Считает распакованные байты и прерывает чтение при превышении лимита"""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.limit + 1 - self.size
+        chunk = self.stream.read(size)
+        self.size += len(chunk)
+        if self.size > self.limit:
+            raise RequestTooLarge(f"Decompressed request exceeds {self.limit} bytes")
+        return chunk
+
+
+def detect_compression(head):
+    """Определение формата сжатия по сигнатуре файла"""
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+def parse_encoded_json(raw, encoding):
+    """Потоковая распаковка и разбор JSON.
+
+    Распаковщик читается порциями и сразу передается в ijson, поэтому
+    распакованное тело целиком в памяти не появляется. Возвращает данные
+    и размер распакованного тела.
+    """
+    with pipeline_stage('parse_json'):
+        if encoding == 'gzip':
+            decoded = gzip.GzipFile(fileobj=raw, mode='rb')
+        else:
+            decoded = zstandard.ZstdDecompressor().stream_reader(raw)
+        reader = LimitedReader(decoded, MAX_REQUEST_SIZE)
+        values = ijson.items(reader, '', use_float=True)
+        json_data = next(values, None)
+        if json_data is None:
+            raise ValueError("No data provided")
+        # Дочитываем поток до конца: после значения допускаются только пробелы,
+        # как и при разборе несжатого тела через json.loads
+        for _ in values:
+            raise ValueError("Extra data after JSON value")
+        return json_data, reader.size
+
+async def parse_compressed_body(request_id, profile, raw, encoding):
+    """Разбор сжатого тела запроса с проверкой поддержки формата и лимита размера"""
+    if encoding not in SUPPORTED_CONTENT_ENCODINGS or ijson is None:
+        logger.error(f"[{request_id}] Unsupported Content-Encoding: {encoding}")
+        raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding: {encoding}")
+    try:
+        return await run_in_threadpool(run_profiled, profile, parse_encoded_json, raw, encoding)
+    except RequestTooLarge as e:
+        logger.error(f"[{request_id}] {str(e)}")
+        raise HTTPException(status_code=413, detail="Request too large")
+    except Exception as e:
+        logger.error(f"[{request_id}] Compressed JSON parsing error: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid compressed JSON data: {str(e)}")
+
 @app.post("/generate-pdf")
 async def generate_pdf(
     request: Request, 
     data: str = Query(None),
+    optimize: bool = Query(None),
     file: UploadFile = File(None)
 ):
-    request_id = f"pdf_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+    request_id = f"pdf_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{uuid.uuid4().hex[:6]}"
     temp_dir = None
-    with request_processing_duration.time():
-        try:
-            request_body = None
-            
-            # Логируем начало обработки
-            logger.info(f"[{request_id}] Starting PDF generation")
-            
-            # Сначала пробуем получить данные из файла
-            if file:
+    cancellation = CancellationToken(request_deadline(request))
+    work_started = None
+    estimate = 0.0
+    profile = RequestProfile.start(request, request_id)
+    try:
+        request_body = None
+        json_data = None
+        content_encoding = request.headers.get('content-encoding', 'identity').strip().lower()
+        
+        # Логируем начало обработки
+        logger.info(f"[{request_id}] Starting PDF generation")
+        
+        # Сначала пробуем получить данные из файла
+        if file:
+            encoding = detect_compression(await file.read(4))
+            await file.seek(0)
+            if encoding:
+                # Сжатый файл распаковываем потоково прямо в JSON парсер
+                json_data, data_size = await parse_compressed_body(
+                    request_id, profile, file.file, encoding
+                )
+                logger.info(f"[{request_id}] Received {encoding} data from file upload, decompressed size: {data_size} bytes")
+            else:
                 request_body = await file.read()
                 request_body = request_body.decode('utf-8')
                 logger.info(f"[{request_id}] Received data from file upload, size: {len(request_body)} bytes")
-            # Затем из query параметра
-            elif data:
-                request_body = data
-                logger.info(f"[{request_id}] Received data from query parameter, size: {len(data)} bytes")
-            else:
-                # Если данных нет ни в файле, ни в query, читаем тело запроса
-                try:
-                    body = await request.body()
-                    request_body = body.decode('utf-8')
-                    logger.info(f"[{request_id}] Received data from request body, size: {len(request_body)} bytes")
-                except Exception as e:
-                    logger.error(f"[{request_id}] Error reading request body: {str(e)}")
-                    raise HTTPException(status_code=400, detail="No data provided or invalid request format")
+        # Затем из query параметра
+        elif data:
+            request_body = data
+            logger.info(f"[{request_id}] Received data from query parameter, size: {len(data)} bytes")
+        elif content_encoding != 'identity':
+            # Сжатое тело запроса (Content-Encoding: gzip/zstd) не собираем в памяти целиком
+            reader = AsyncBodyReader(request.stream())
+            json_data, data_size = await parse_compressed_body(
+                request_id, profile, reader, content_encoding
+            )
+            logger.info(
+                f"[{request_id}] Received {content_encoding} data from request body, "
+                f"size: {reader.raw_bytes} bytes, decompressed size: {data_size} bytes"
+            )
+        else:
+            # Если данных нет ни в файле, ни в query, читаем тело запроса
+            try:
+                body = await request.body()
+                request_body = body.decode('utf-8')
+                logger.info(f"[{request_id}] Received data from request body, size: {len(request_body)} bytes")
+            except Exception as e:
+                logger.error(f"[{request_id}] Error reading request body: {str(e)}")
+                raise HTTPException(status_code=400, detail="No data provided or invalid request format")
 
+        if json_data is None:
             if not request_body:
                 logger.error(f"[{request_id}] No data provided in request")
                 raise HTTPException(status_code=400, detail="No data provided")
 
             # Проверяем размер данных
             data_size = len(request_body)
-            if data_size > 50 * 1024 * 1024:  # 50MB limit
+            if data_size > MAX_REQUEST_SIZE:
                 raise HTTPException(status_code=413, detail="Request too large")
-            
-            # Создаем временную директорию с уникальным именем
-            base_temp = os.environ.get('TMPDIR', '/tmp')
-            temp_dir = os.path.join(base_temp, f'pdf_gen_{datetime.now().strftime("%Y%m%d_%H%M%S")}_{os.getpid()}')
-            os.makedirs(temp_dir, mode=0o755, exist_ok=True)
-            logger.debug(f"Created temporary directory: {temp_dir}")
-            
+
             # Парсим JSON данные
             try:
-                json_data = json.loads(request_body)
+                json_data = await run_in_threadpool(
+                    run_cancellable, cancellation, run_profiled, profile, parse_json, request_body
+                )
             except json.JSONDecodeError as e:
                 logger.error(f"[{request_id}] JSON parsing error: {str(e)}")
                 raise HTTPException(status_code=400, detail=f"Invalid JSON data: {str(e)}")
             except Exception as e:
                 logger.error(f"[{request_id}] Unexpected error during JSON parsing: {str(e)}")
                 raise HTTPException(status_code=500, detail="Error processing JSON data")
-            
-            docx_path = os.path.join(temp_dir, "output.docx")
-            pdf_path = os.path.join(temp_dir, "output.pdf")
-            
-            # Загружаем шаблон
-            template_path = "templates/template.docx"
-            logger.debug(f"[{request_id}] Loading template from: {template_path}")
-            doc = DocxTemplate(template_path)
-            
-            # Подготавливаем данные для таблицы
-            table_data = json_data.copy()  # Создаем копию для модификации
-            
-            # Обрабатываем данные заявителя в зависимости от типа
-            logger.debug(f"[{request_id}] Applicant type: {json_data.get('applicantType')}")
-            
-            if json_data.get('applicantType') == 'ORGANIZATION':
-                if json_data.get('organizationInfo'):
-                    # Для организации используем полные данные
-                    table_data['applicant_info'] = (
-                        f"{json_data['organizationInfo'].get('name', '')}, "
-                        f"{json_data['organizationInfo'].get('address', '')}, "
-                        f"{json_data['organizationInfo'].get('agent', '')}"
+            del request_body
+        
+        # Создаем временную директорию с уникальным именем
+        base_temp = os.environ.get('TMPDIR', '/tmp')
+        temp_dir = tempfile.mkdtemp(prefix=f'pdf_gen_{datetime.now().strftime("%Y%m%d_%H%M%S")}_', dir=base_temp)
+        logger.debug(f"Created temporary directory: {temp_dir}")
+
+        # Ждем слот конвертации; блокирующая работа выполняется в пуле потоков
+        registry_items = json_data.get('registryItems') if isinstance(json_data, dict) else None
+        rows = len(registry_items) if isinstance(registry_items, list) else 0
+        estimate = conversion_scheduler.cost_model.estimate(rows, data_size)
+        cancellation.check('queue')
+        # Пока LibreOffice неисправен, не ставим заявку в очередь
+        conversion_supervisor.breaker.check()
+
+        async def produce_pdf():
+            nonlocal work_started
+            async with conversion_scheduler.slot(rows, data_size) as converter:
+                work_started = time.perf_counter()
+                logger.debug(f"[{request_id}] Acquired converter {converter}")
+                with profile.trace_memory() if profile is not None else nullcontext():
+                    return await run_in_threadpool(
+                        run_cancellable, cancellation, run_profiled, profile, build_pdf,
+                        json_data, temp_dir, request_id, converter,
+                        PDF_OPTIMIZE_DEFAULT if optimize is None else optimize
                     )
-                    table_data['applicant_name'] = json_data['organizationInfo'].get('name', '')
-                    table_data['applicant_agent'] = json_data['organizationInfo'].get('agent', '')
-                    table_data['is_organization'] = True
-                else:
-                    table_data['applicant_info'] = ''
-                    table_data['applicant_name'] = ''
-                    table_data['applicant_agent'] = ''
-                    table_data['is_organization'] = True
-            else:  # INDIVIDUAL
-                if json_data.get('individualInfo'):
-                    # Для физ. лица добавляем ЕСИА номер
-                    esia_number = json_data['individualInfo'].get('esia', '')
-                    esia_suffix = f" (ЕСИА {esia_number})" if esia_number else ''
-                    name = json_data['individualInfo'].get('name', '')
-                    
-                    table_data['applicant_info'] = f"{name}{esia_suffix}"
-                    table_data['applicant_name'] = f"физическое лицо {name}"
-                    table_data['applicant_agent'] = ''  # Для физ. лица поле представителя оставляем пустым
-                    table_data['is_organization'] = False
-                else:
-                    table_data['applicant_info'] = ''
-                    table_data['applicant_name'] = ''
-                    table_data['applicant_agent'] = ''
-                    table_data['is_organization'] = False
-            
-            logger.debug(f"[{request_id}] Prepared applicant data: {table_data['applicant_info']}")
-            
-            # Подготавливаем данные для таблицы с оптимизацией памяти
-            if 'registryItems' in json_data:
-                table_data['table_rows'] = process_registry_items(json_data['registryItems'])
-            
-            # Форматируем дату
-            if 'creationDate' in json_data:
-                try:
-                    # Предполагаем, что дата приходит в формате ISO
-                    date_obj = datetime.fromisoformat(json_data['creationDate'].replace('Z', '+00:00'))
-                    table_data['creationDate'] = date_obj.strftime("%d.%m.%Y")
-                    logger.debug(f"[{request_id}] Formatted date: {table_data['creationDate']}")
-                except Exception as e:
-                    logger.error(f"[{request_id}] Error formatting date: {e}")
-            
-            # Выводим все данные перед рендерингом
-            logger.debug(f"[{request_id}] Final template data:")
-            logger.debug(json.dumps(prepare_data_for_logging(table_data), indent=2, ensure_ascii=False))
-            
-            # Оптимизируем рендеринг шаблона
+
+        # Работа прерывается, если клиент отключился или истек дедлайн
+        work = asyncio.ensure_future(produce_pdf())
+        watcher = asyncio.create_task(
+            watch_request(request, cancellation, work, lambda: work_started is None)
+        )
+        try:
+            pdf_path = await work
+        except asyncio.CancelledError:
+            if not cancellation.cancelled():
+                raise
+            raise RequestCancelled(cancellation.reason, cancellation.stage)
+        finally:
+            watcher.cancel()
+        
+        # Сохраняем документ в архив; новая версия вытесняет предыдущую
+        document_version = None
+        application_id = json_data.get('id') if isinstance(json_data, dict) else None
+        if ARCHIVE_ENABLED and application_id:
             try:
-                doc.render(table_data)
-                logger.debug(f"[{request_id}] Template rendered successfully")
-                # Очищаем память после рендеринга
-                gc.collect()
+                document_version = await run_in_threadpool(
+                    document_archive.store,
+                    str(application_id),
+                    json_data.get('operation'),
+                    json_data.get('creationDate'),
+                    pdf_path
+                )
+                logger.info(f"[{request_id}] Archived document {application_id}, version {document_version}")
             except Exception as e:
-                logger.error(f"[{request_id}] Template rendering failed: {str(e)}")
-                logger.error(f"[{request_id}] Template context too large to log")
-                raise
-            
-            # Сохраняем docx
-            logger.debug(f"[{request_id}] Saving DOCX to: {docx_path}")
-            doc.save(docx_path)
-            
-            # Конвертируем в PDF для подсчета страниц
-            convert_to_pdf(docx_path, pdf_path)
-            
-            # Получаем реальное количество страниц в PDF
-            pages = get_pdf_pages(pdf_path)
-            logger.debug(f"[{request_id}] Document has {pages} pages")
-            
-            # Обновляем количество страниц в шаблоне
-            table_data['registry_pages'] = pages - 1  # Вычитаем первую страницу
-            logger.debug(f"[{request_id}] Setting registry_pages to {pages - 1}")
-            
-            # Загружаем шаблон заново
-            doc = DocxTemplate(template_path)
-            
-            # Рендерим документ заново с обновленным количеством страниц
-            doc.render(table_data)
-            doc.save(docx_path)
-            
-            # Конвертируем в PDF финальную версию
-            convert_to_pdf(docx_path, pdf_path)
-            
-            # Проверяем, что количество страниц корректно обновилось
-            final_pages = get_pdf_pages(pdf_path)
-            logger.debug(f"[{request_id}] Final document has {final_pages} pages, registry_pages set to {table_data['registry_pages']}")
-            
-            # Обновляем метрики
-            temp_files = sum([len(files) for r, d, files in os.walk(temp_dir)])
-            temp_files_gauge.set(temp_files)
-            memory_usage_gauge.set(gc.get_count()[0] * 1024 * 1024)
-            
-            # Возвращаем PDF файл
-            response = FileResponse(
-                pdf_path,
-                media_type="application/pdf",
-                filename="application.pdf"
-            )
-            
-            # Создаем асинхронную функцию для очистки
-            async def background_cleanup():
-                await cleanup_temp_files(temp_dir)
-            
-            # Добавляем обработчик для очистки после отправки файла
-            response.background = background_cleanup
-            
-            return response
+                logger.error(f"[{request_id}] Error archiving document: {str(e)}")
+
+        # Обновляем метрики
+        temp_files = sum([len(files) for r, d, files in os.walk(temp_dir)])
+        temp_files_gauge.set(temp_files)
+        memory_usage_gauge.set(gc.get_count()[0] * 1024 * 1024)
         
-        except Exception as e:
-            pdf_conversion_errors.inc()
-            if temp_dir and os.path.exists(temp_dir):
-                await cleanup_temp_files(temp_dir)
-            logger.error(f"[{request_id}] Error in generate_pdf: {str(e)}")
-            raise HTTPException(status_code=500, detail=str(e))
+        # Возвращаем PDF файл
+        response = FileResponse(
+            pdf_path,
+            media_type="application/pdf",
+            filename="application.pdf"
+        )
+        if profile is not None:
+            response.headers['X-Profile-Id'] = profile.profile_id
+        if document_version is not None:
+            response.headers['X-Document-Version'] = str(document_version)
+        
+        # Добавляем обработчик для очистки после отправки файла
+        response.background = BackgroundTask(cleanup_temp_files, temp_dir)
+        
+        return response
+    
+    except RequestCancelled as e:
+        # Учитываем потраченную впустую и сэкономленную емкость конвертации
+        wasted = time.perf_counter() - work_started if work_started is not None else 0.0
+        requests_cancelled.labels(reason=e.reason, stage=e.stage or 'queue').inc()
+        cancelled_work_seconds.labels(reason=e.reason).inc(wasted)
+        cancelled_saved_seconds.labels(reason=e.reason).inc(max(0.0, estimate - wasted))
+        if temp_dir and os.path.exists(temp_dir):
+            await run_in_threadpool(cleanup_temp_files, temp_dir)
+        logger.warning(f"[{request_id}] {str(e)}, {wasted:.2f}s of conversion work discarded")
+        if e.reason == 'deadline':
+            raise HTTPException(status_code=504, detail="Request deadline exceeded")
+        raise HTTPException(status_code=499, detail="Client closed request")
+
+    except ConverterUnavailable as e:
+        if temp_dir and os.path.exists(temp_dir):
+            await run_in_threadpool(cleanup_temp_files, temp_dir)
+        logger.warning(f"[{request_id}] {str(e)}")
+        raise HTTPException(
+            status_code=503,
+            detail="PDF converter is temporarily unavailable",
+            headers={'Retry-After': str(math.ceil(e.retry_after))}
+        )
+
+    except Exception as e:
+        pdf_conversion_errors.inc()
+        if temp_dir and os.path.exists(temp_dir):
+            await run_in_threadpool(cleanup_temp_files, temp_dir)
+        logger.error(f"[{request_id}] Error in generate_pdf: {str(e)}")
+        if isinstance(e, HTTPException) and e.status_code in PASSTHROUGH_STATUS_CODES:
+            raise
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if profile is not None:
+            await run_in_threadpool(profile.finish)
+
+@app.post("/admin/profiling")
+async def arm_profiling(request: Request, requests: int = Query(1, ge=0, le=100)):
+    """Включает профилирование для следующих N запросов генерации PDF"""
+    require_profiling_token(request)
+    RequestProfile.arm(requests)
+    logger.info(f"Profiling armed for next {requests} requests")
+    return {"armed": requests}
+
+@app.get("/admin/profiles")
+async def list_profiles(request: Request):
+    """Список сохраненных профилей"""
+    require_profiling_token(request)
+    if not os.path.isdir(PROFILES_DIR):
+        return {"profiles": []}
+    profile_ids = sorted({os.path.splitext(name)[0] for name in os.listdir(PROFILES_DIR)}, reverse=True)
+    return {"profiles": profile_ids}
+
+@app.get("/admin/profiles/{profile_id}/{artifact}")
+async def download_profile(request: Request, profile_id: str, artifact: str):
+    """Скачивание артефакта профиля: prof (cProfile), txt (pstats) или json (этапы и память)"""
+    require_profiling_token(request)
+    if artifact not in PROFILE_ARTIFACTS or os.path.basename(profile_id) != profile_id:
+        raise HTTPException(status_code=404, detail="Profile artifact not found")
+    path = os.path.join(PROFILES_DIR, f"{profile_id}.{artifact}")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile artifact not found")
+    return FileResponse(path, media_type=PROFILE_ARTIFACTS[artifact], filename=f"{profile_id}.{artifact}")
+
+@app.get("/documents/{application_id}")
+async def get_document(request: Request, application_id: str, operation: str = Query(None)):
+    """Последняя сгенерированная версия документа заявки без повторной генерации"""
+    require_archive_token(request)
+    document, file = await run_in_threadpool(document_archive.open_latest, application_id, operation)
+    if document is None:
+        archive_requests.labels(result='miss').inc()
+        raise HTTPException(status_code=404, detail="Document not found")
+    archive_requests.labels(result='hit').inc()
+    # Отдаем уже открытый файл: версия может быть вытеснена во время отправки
+    return StreamingResponse(
+        iter_file(file),
+        media_type="application/pdf",
+        headers={
+            'Content-Disposition': 'attachment; filename="application.pdf"',
+            'Content-Length': str(os.fstat(file.fileno()).st_size),
+            'X-Document-Version': str(document['version']),
+        }
+    )
+
+@app.get("/documents/{application_id}/versions")
+async def get_document_versions(request: Request, application_id: str):
+    """Список хранимых версий документа заявки"""
+    require_archive_token(request)
+    versions = await run_in_threadpool(document_archive.versions, application_id)
+    return {"id": application_id, "versions": versions}
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Готовность принимать запросы: очередь конвертации и время ее разбора не выше порогов,
+    автоматический выключатель конвертаций не разомкнут"""
+    queue_depth = conversion_scheduler.queue_depth()
+    drain_seconds = conversion_scheduler.drain_estimate()
+    circuit = conversion_supervisor.breaker.state
+    ready = queue_depth <= READINESS_MAX_QUEUE and circuit != CircuitBreaker.OPEN and (
+        READINESS_MAX_DRAIN_SECONDS <= 0 or drain_seconds <= READINESS_MAX_DRAIN_SECONDS
+    )
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "not_ready",
+            "queue_depth": queue_depth,
+            "in_flight": conversion_scheduler.in_flight(),
+            "slots": conversion_scheduler.slots,
+            "estimated_drain_seconds": round(drain_seconds, 3),
+            "circuit": circuit,
+        }
+    )
+
 if __name__ == "__main__":
     # Настройки uvicorn для стабильной работы с большими файлами
     log_config = {
@@ -641,6 +2678,8 @@ if __name__ == "__main__":
         proxy_headers=True,
         forwarded_allow_ips="*",
         reload=should_reload,
-        http='h11',
-        loop='asyncio'
+        # Реализации HTTP парсера и event loop: h11/httptools/auto и asyncio/uvloop/auto
+        # (httptools и uvloop устанавливаются с uvicorn[standard])
+        http=os.environ.get('UVICORN_HTTP', 'h11'),
+        loop=os.environ.get('UVICORN_LOOP', 'asyncio')
     )
@@ -0,0 +1,205 @@
+"""Пакетная генерация PDF из JSONL файла без HTTP сервиса.
+
+Каждая строка входного файла - JSON заявки в том же формате, что и тело
+POST /generate-pdf. Заявки обрабатываются пулом процессов, у каждого процесса
+свой экземпляр LibreOffice. Результаты пишутся в выходную директорию, а ход
+работы - в manifest.jsonl, поэтому прерванный запуск можно продолжить.
+
+Пример:
+    python bulk_generate.py payloads.jsonl --output out/ --workers 4
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing.util import Finalize
+
+import app
+
+logger = logging.getLogger('app.bulk')
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+# Номер LibreOffice профиля процесса пула
+_worker_converter = None
+
+
+def _init_worker(log_level):
+    """Инициализация процесса пула: свой профиль LibreOffice на процесс.
+
+    Хеджирование и автоматический выключатель сервиса в пакетном режиме отключены:
+    очередь планировщика здесь всегда пуста, и дубли каждого процесса заняли бы
+    все ядра, а серия некорректных заявок отклоняла бы последующие строки.
+    Повтор после сбоя LibreOffice сохраняется.
+    """
+    global _worker_converter
+    _worker_converter = f'bulk_{os.getpid()}'
+    # Профили LibreOffice процесса удаляются при его завершении
+    Finalize(None, _remove_worker_profiles, args=(_worker_converter,), exitpriority=10)
+    app.conversion_supervisor = app.ConversionSupervisor(
+        app.CircuitBreaker(0, 0),
+        app.ConversionLatency(),
+        retries=app.CONVERSION_RETRIES,
+        hedge_enabled=False,
+    )
+    logging.getLogger().setLevel(log_level)
+    logging.getLogger('app').setLevel(log_level)
+
+
+def _remove_worker_profiles(converter):
+    for name in (converter, f'hedge_{converter}'):
+        shutil.rmtree(app.libreoffice_profile_dir(name), ignore_errors=True)
+
+
+def line_digest(line):
+    """Хеш строки входного файла: при продолжении пропускаются только неизмененные заявки"""
+    return hashlib.sha256(line.strip().encode('utf-8')).hexdigest()
+
+
+def output_name(line_no, application_id):
+    """Имя выходного файла: номер строки и id заявки, безопасный для файловой системы"""
+    safe_id = re.sub(r'[^\w.-]+', '_', str(application_id or 'unknown'))
+    return f'{line_no:06d}_{safe_id}.pdf'
+
+
+def load_manifest(manifest_path):
+    """Успешно обработанные в предыдущих запусках строки: номер строки -> (имя PDF, хеш строки)"""
+    done = {}
+    if not os.path.exists(manifest_path):
+        return done
+    with open(manifest_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла быть записана не полностью
+                continue
+            if record.get('status') == 'ok':
+                done[record['line']] = (record['output'], record.get('sha256'))
+            else:
+                done.pop(record['line'], None)
+    return done
+
+
+def iter_pending(input_path, output_dir, done):
+    """Строки входного файла, которые еще нужно обработать"""
+    with open(input_path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            if line_no in done:
+                output, digest = done[line_no]
+                # Строка могла измениться или сместиться после правки файла
+                if digest == line_digest(line) and os.path.exists(os.path.join(output_dir, output)):
+                    continue
+            yield line_no, line
+
+
+def generate_one(line_no, line, output_dir, optimize):
+    """Генерация одного PDF в процессе пула; возвращает запись для манифеста"""
+    started = time.perf_counter()
+    request_id = f'bulk_{line_no:06d}'
+    record = {'line': line_no, 'sha256': line_digest(line)}
+    temp_dir = None
+    try:
+        json_data = json.loads(line)
+        record['id'] = json_data.get('id')
+        record['operation'] = json_data.get('operation')
+        record['creationDate'] = json_data.get('creationDate')
+        temp_dir = tempfile.mkdtemp(prefix=f'{request_id}_', dir=os.environ.get('TMPDIR', '/tmp'))
+        pdf_path = app.build_pdf(json_data, temp_dir, request_id, _worker_converter, optimize)
+        output = output_name(line_no, record['id'])
+        shutil.move(pdf_path, os.path.join(output_dir, output))
+        record.update(status='ok', output=output)
+    except Exception as e:
+        logger.error(f"[{request_id}] Bulk generation failed: {str(e)}")
+        record.update(status='error', error=str(e))
+    finally:
+        if temp_dir:
+            app.cleanup_temp_files(temp_dir)
+    record['seconds'] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run_bulk(input_path, output_dir, workers, optimize=False, archive=False, log_level='INFO'):
+    """Обработка всех незавершенных строк; возвращает (успешно, ошибок)"""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    done = load_manifest(manifest_path)
+    if done:
+        logger.info(f"Resuming: {len(done)} documents already generated")
+
+    succeeded = failed = 0
+    started = time.perf_counter()
+    with open(manifest_path, 'a', encoding='utf-8') as manifest, ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(log_level,)
+    ) as executor:
+        pending = set()
+        lines = iter_pending(input_path, output_dir, done)
+        exhausted = False
+        while pending or not exhausted:
+            # Держим в очереди не больше двух заявок на процесс, чтобы не читать весь файл в память
+            while not exhausted and len(pending) < workers * 2:
+                item = next(lines, None)
+                if item is None:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(generate_one, *item, output_dir, optimize))
+            if not pending:
+                break
+            completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                record = future.result()
+                if record['status'] == 'ok' and archive and record.get('id'):
+                    try:
+                        app.document_archive.store(
+                            str(record['id']),
+                            record.get('operation'),
+                            record.get('creationDate'),
+                            os.path.join(output_dir, record['output'])
+                        )
+                    except Exception as e:
+                        # Строка будет обработана повторно при следующем запуске
+                        logger.error(f"Archiving line {record['line']} failed: {str(e)}")
+                        record.update(status='error', error=f'archive: {str(e)}')
+                if record['status'] == 'ok':
+                    succeeded += 1
+                else:
+                    failed += 1
+                manifest.write(json.dumps(record, ensure_ascii=False) + '\n')
+                manifest.flush()
+            processed = succeeded + failed
+            if processed and processed % 100 == 0:
+                rate = processed / (time.perf_counter() - started)
+                logger.info(f"Processed {processed} documents ({rate:.2f}/s), failed: {failed}")
+
+    logger.info(f"Bulk generation finished: {succeeded} generated, {failed} failed")
+    return succeeded, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Пакетная генерация PDF из JSONL файла')
+    parser.add_argument('input', help='JSONL файл с заявками, по одной на строку')
+    parser.add_argument('-o', '--output', default='bulk_output', help='Директория для PDF и manifest.jsonl')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help='Количество процессов')
+    parser.add_argument('--optimize', action='store_true', help='Постобработка PDF (линеаризация, сжатие)')
+    parser.add_argument('--archive', action='store_true', help='Сохранять документы в архив сервиса')
+    parser.add_argument('--log-level', default='INFO', help='Уровень логирования')
+    args = parser.parse_args(argv)
+
+    log_level = args.log_level.upper()
+    logging.getLogger().setLevel(log_level)
+    logging.getLogger('app').setLevel(log_level)
+    _, failed = run_bulk(args.input, args.output, max(1, args.workers), args.optimize, args.archive, log_level)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
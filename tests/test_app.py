@@ -1,8 +1,19 @@
 import pytest
 from fastapi.testclient import TestClient
 from app import app
+import app as app_module
+import asyncio
+import gzip
+import io
 import json
 import os
+import shutil
+import threading
+import time
+import tracemalloc
+import zipfile
+from types import SimpleNamespace
+from PyPDF2 import PdfReader, PdfWriter
 
 client = TestClient(app)
 
@@ -63,4 +74,528 @@ def test_generate_pdf_success():
         )
 
     assert response.status_code == 200
-    assert response.headers["content-type"] == "application/pdf" 
\ No newline at end of file
+    assert response.headers["content-type"] == "application/pdf"
+
+def sample_value(name, labels=None):
+    return app_module.metrics_registry.get_sample_value(name, labels) or 0
+
+def write_blank_pdf(path, pages=1):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    with open(path, "wb") as f:
+        writer.write(f)
+
+def registry_application(application_id, items):
+    # Поля, без которых шаблон не рендерится
+    return {
+        "id": application_id,
+        "operation": "CREATE",
+        "creationDate": "2024-01-01T00:00:00Z",
+        "geoInfoStorageOrganization": {"value": "Storage"},
+        "purposeOfGeoInfoAccessDictionary": {"value": "Purpose"},
+        "registryItems": items,
+    }
+
+def build_in(directory, data):
+    directory.mkdir()
+    return app_module.build_pdf(data, str(directory), "test")
+
+@pytest.fixture
+def incremental_build(tmp_path, monkeypatch):
+    # LibreOffice заменен записью пустых страниц; список converted хранит сконвертированные файлы
+    conversion = SimpleNamespace(converted=[], segment_pages=1)
+
+    def fake_run_conversion(input_docx_list, abs_output_dir, converter=None, timeout=60):
+        for docx_path in input_docx_list:
+            name = os.path.basename(docx_path)
+            conversion.converted.append(name)
+            pages = 1 if name.startswith("cover") else conversion.segment_pages
+            write_blank_pdf(os.path.splitext(docx_path)[0] + ".pdf", pages)
+
+    monkeypatch.setattr(app_module, "run_conversion", fake_run_conversion)
+    monkeypatch.setattr(app_module, "INCREMENTAL_ENABLED", True)
+    monkeypatch.setattr(app_module, "INCREMENTAL_CACHE_DIR", str(tmp_path / "segments"))
+    monkeypatch.setattr(app_module, "INCREMENTAL_MIN_ROWS", 10)
+    monkeypatch.setattr(app_module, "INCREMENTAL_SEGMENT_ROWS", 5)
+    return conversion
+
+def test_profiling_endpoints_disabled_without_token():
+    response = client.get("/admin/profiles")
+    assert response.status_code == 404
+
+def test_profiling_artifacts(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "PROFILING_TOKEN", "secret")
+    monkeypatch.setattr(app_module, "PROFILES_DIR", str(tmp_path))
+
+    response = client.post("/admin/profiling?requests=1", headers={"X-Profile-Token": "wrong"})
+    assert response.status_code == 403
+
+    response = client.post("/admin/profiling?requests=1", headers={"X-Profile-Token": "secret"})
+    assert response.json() == {"armed": 1}
+
+    request = type("FakeRequest", (), {"headers": {}})()
+    profile = app_module.RequestProfile.start(request, "test")
+    assert profile is not None
+    assert app_module.RequestProfile.start(request, "test") is None
+    # Трассировка памяти включается только на время генерации
+    assert not tracemalloc.is_tracing()
+    with profile.trace_memory(), profile.capture():
+        with app_module.pipeline_stage("process_registry_items"):
+            app_module.process_registry_items([{"id": "1", "name": "test"}])
+    assert not tracemalloc.is_tracing()
+    profile.finish()
+
+    response = client.get("/admin/profiles", headers={"X-Profile-Token": "secret"})
+    assert response.json() == {"profiles": [profile.profile_id]}
+    response = client.get(f"/admin/profiles/{profile.profile_id}/json", headers={"X-Profile-Token": "secret"})
+    summary = response.json()
+    assert summary["stages"][0]["stage"] == "process_registry_items"
+    assert summary["memory"]["peak_bytes"] > 0
+
+def test_conversion_scheduler_shortest_job_first():
+    from app import ConversionScheduler, ConversionCostModel
+
+    async def scenario():
+        scheduler = ConversionScheduler(1, ConversionCostModel(base=1.0, per_row=1.0), aging_rate=0.0)
+        order = []
+
+        async def job(name, rows):
+            async with scheduler.slot(rows, 0):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        blocker = asyncio.create_task(job("first", 1))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(job(name, rows)) for name, rows in [("large", 1000), ("small", 1), ("medium", 10)]]
+        await asyncio.gather(blocker, *waiting)
+        return order
+
+    assert asyncio.run(scenario()) == ["first", "small", "medium", "large"]
+
+def test_conversion_scheduler_aging_and_class_limits():
+    from app import ConversionScheduler, ConversionCostModel, _ConversionTicket
+
+    scheduler = ConversionScheduler(
+        2, ConversionCostModel(), aging_rate=1.0,
+        class_bounds={"small": 5}, class_limits={"large": 1}
+    )
+    assert scheduler.classify(1) == "small"
+    assert scheduler.classify(100) == "large"
+
+    class Future:
+        def set_result(self, value):
+            self.result = value
+
+    now = time.monotonic()
+    old_large = _ConversionTicket(50, "large", now - 100, Future())
+    new_large = _ConversionTicket(40, "large", now, Future())
+    small = _ConversionTicket(1, "small", now, Future())
+    scheduler._waiting = [old_large, new_large, small]
+    scheduler._dispatch()
+    # Старая большая заявка обгоняет мелкую, вторая large упирается в лимит класса
+    assert scheduler._waiting == [new_large]
+    assert old_large.future.result == 0 and small.future.result == 1
+
+def test_conversion_cost_model_calibration():
+    from app import ConversionCostModel
+
+    model = ConversionCostModel(base=1.0, per_row=0.0)
+    for rows in [10, 100, 1000, 5000] * 10:
+        model.observe(rows, 0, 2.0 + 0.01 * rows)
+    assert abs(model.estimate(2000, 0) - 22.0) < 1.0
+
+def test_parse_encoded_json():
+    import zstandard
+    from app import parse_encoded_json
+
+    payload = {"id": "39-24", "registryItems": [{"id": str(i), "note": "Документ недоступен"} for i in range(1000)]}
+    raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+    assert parse_encoded_json(io.BytesIO(gzip.compress(raw)), "gzip") == (payload, len(raw))
+    compressed = zstandard.ZstdCompressor().compress(raw)
+    assert parse_encoded_json(io.BytesIO(compressed), "zstd") == (payload, len(raw))
+
+    # Данные после JSON значения отклоняются так же, как у несжатого тела
+    assert parse_encoded_json(io.BytesIO(gzip.compress(raw + b" \n")), "gzip") == (payload, len(raw) + 2)
+    with pytest.raises(Exception):
+        parse_encoded_json(io.BytesIO(gzip.compress(raw + b" garbage")), "gzip")
+    response = client.post(
+        "/generate-pdf",
+        content=gzip.compress(raw + b" garbage"),
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}
+    )
+    assert response.status_code == 500
+
+def test_generate_pdf_compressed_body_limits(monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_REQUEST_SIZE", 1024)
+
+    bomb = gzip.compress(b'{"note": "' + b"a" * 10 * 1024 * 1024 + b'"}')
+    response = client.post(
+        "/generate-pdf",
+        content=bomb,
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}
+    )
+    assert response.status_code == 413
+
+    response = client.post(
+        "/generate-pdf",
+        content=b"{}",
+        headers={"Content-Type": "application/json", "Content-Encoding": "br"}
+    )
+    assert response.status_code == 415
+
+def test_document_archive(tmp_path, monkeypatch):
+    archive = app_module.DocumentArchive(str(tmp_path), retention_days=30, max_bytes=0, keep_versions=1)
+    monkeypatch.setattr(app_module, "document_archive", archive)
+    monkeypatch.setattr(app_module, "ARCHIVE_ENABLED", True)
+    monkeypatch.setattr(app_module, "ARCHIVE_TOKEN", "secret")
+
+    pdf_path = tmp_path / "output.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4 first")
+    assert archive.store("39-24", "CREATE", "2024-01-01T00:00:00Z", str(pdf_path)) == 1
+    pdf_path.write_bytes(b"%PDF-1.4 second")
+    assert archive.store("39-24", "UPDATE", "2024-01-02T00:00:00Z", str(pdf_path)) == 2
+
+    # Предыдущая версия вытеснена новой
+    assert [v["version"] for v in archive.versions("39-24")] == [2]
+    assert archive.latest("39-24", "CREATE") is None
+
+    # Архив доступен только с токеном
+    assert client.get("/documents/39-24").status_code == 403
+    headers = {"X-Archive-Token": "secret"}
+    response = client.get("/documents/39-24", headers=headers)
+    assert response.status_code == 200
+    assert response.content == b"%PDF-1.4 second"
+    assert response.headers["X-Document-Version"] == "2"
+    assert client.get("/documents/unknown", headers=headers).status_code == 404
+
+    # Открытый файл отдается целиком, даже если версию вытеснили во время отправки
+    document, file = archive.open_latest("39-24")
+    archive.store("39-24", "UPDATE", "2024-01-03T00:00:00Z", str(pdf_path))
+    assert not os.path.exists(document["path"])
+    assert b"".join(app_module.iter_file(file)) == b"%PDF-1.4 second"
+
+    # Номера версий не повторяются после очистки по сроку хранения
+    archive.retention_days = 1e-9
+    archive.enforce_policies()
+    assert archive.versions("39-24") == []
+    archive.retention_days = 30
+    assert archive.store("39-24", "UPDATE", "2024-01-04T00:00:00Z", str(pdf_path)) == 4
+
+def test_document_archive_size_policy(tmp_path):
+    from app import DocumentArchive
+    archive = DocumentArchive(str(tmp_path), retention_days=30, max_bytes=25, keep_versions=1)
+
+    pdf_path = tmp_path / "output.pdf"
+    pdf_path.write_bytes(b"x" * 10)
+    for application_id in ["1", "2", "3"]:
+        archive.store(application_id, "CREATE", None, str(pdf_path))
+    assert archive.latest("1") is None
+    assert archive.latest("2") is not None and archive.latest("3") is not None
+
+def test_readiness_reports_queue_saturation(monkeypatch):
+    from app import ConversionScheduler, ConversionCostModel, _ConversionTicket
+
+    scheduler = ConversionScheduler(1, ConversionCostModel())
+    monkeypatch.setattr(app_module, "conversion_scheduler", scheduler)
+    monkeypatch.setattr(app_module, "READINESS_MAX_QUEUE", 1)
+
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+
+    now = time.monotonic()
+    scheduler._waiting = [_ConversionTicket(10, "medium", now, None) for _ in range(2)]
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["queue_depth"] == 2
+    assert response.json()["estimated_drain_seconds"] == 20
+    # Liveness не зависит от нагрузки
+    assert client.get("/health").status_code == 200
+
+def test_optimize_pdf_linearizes_and_deduplicates(tmp_path):
+    pikepdf = pytest.importorskip("pikepdf")
+    from app import optimize_pdf
+
+    pdf = pikepdf.new()
+    for _ in range(3):
+        pdf.add_blank_page()
+        image = pikepdf.Stream(pdf, b"\xff" * 3000)
+        image.Type = pikepdf.Name.XObject
+        image.Subtype = pikepdf.Name.Image
+        image.Width, image.Height = 100, 10
+        image.ColorSpace = pikepdf.Name.DeviceGray
+        image.BitsPerComponent = 8
+        pdf.pages[-1].Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Im0=image))
+        pdf.pages[-1].Contents = pdf.make_stream(b"q 100 0 0 10 0 0 cm /Im0 Do Q")
+    source = tmp_path / "output.pdf"
+    pdf.save(source, compress_streams=False)
+
+    result = optimize_pdf(str(source), str(tmp_path / "output.optimized.pdf"))
+    assert os.path.getsize(result) < os.path.getsize(source)
+    with pikepdf.open(result) as optimized:
+        assert optimized.is_linearized
+        images = {page.Resources.XObject.Im0.objgen for page in optimized.pages}
+        assert len(images) == 1
+
+def test_optimize_pdf_falls_back_on_error(tmp_path):
+    pytest.importorskip("pikepdf")
+    from app import optimize_pdf
+
+    source = tmp_path / "output.pdf"
+    source.write_bytes(b"%PDF-1.4 broken")
+    before = sample_value("pdf_optimize_failures_total")
+    assert optimize_pdf(str(source), str(tmp_path / "output.optimized.pdf")) == str(source)
+    assert sample_value("pdf_optimize_failures_total") - before == 1
+    assert not (tmp_path / "output.optimized.pdf").exists()
+
+def test_bulk_generate_resumes_from_manifest(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import bulk_generate
+
+    def fake_build_pdf(json_data, temp_dir, request_id, converter=None, optimize=False):
+        if json_data["id"] == "broken":
+            raise Exception("conversion failed")
+        pdf_path = os.path.join(temp_dir, "output.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(b"%PDF-1.4")
+        return pdf_path
+
+    monkeypatch.setattr(bulk_generate.app, "build_pdf", fake_build_pdf)
+    input_path = tmp_path / "payloads.jsonl"
+    input_path.write_text("\n".join(json.dumps({"id": i}) for i in ["39-24", "broken", "40/24"]) + "\n")
+    output_dir = tmp_path / "out"
+
+    # Пул процессов заменяем пулом потоков, чтобы подмена build_pdf действовала
+    monkeypatch.setattr(bulk_generate, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(bulk_generate, "_init_worker", lambda log_level: None)
+
+    assert bulk_generate.run_bulk(str(input_path), str(output_dir), workers=2) == (2, 1)
+    assert sorted(os.listdir(output_dir)) == ["000001_39-24.pdf", "000003_40_24.pdf", "manifest.jsonl"]
+
+    # Повторный запуск обрабатывает только строку с ошибкой
+    assert bulk_generate.run_bulk(str(input_path), str(output_dir), workers=2) == (0, 1)
+    records = [json.loads(line) for line in (output_dir / "manifest.jsonl").read_text().splitlines()]
+    assert [r["line"] for r in records][-1] == 2
+    assert len(records) == 4
+
+    # После правки входного файла строка с другим содержимым генерируется заново
+    input_path.write_text("\n".join(json.dumps({"id": i}) for i in ["41-24", "broken", "40/24"]) + "\n")
+    assert bulk_generate.run_bulk(str(input_path), str(output_dir), workers=2) == (1, 1)
+    assert "000001_41-24.pdf" in os.listdir(output_dir)
+
+    # Сбой архива записывается в манифест и не прерывает запуск
+    def failing_store(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(bulk_generate.app.document_archive, "store", failing_store)
+    assert bulk_generate.run_bulk(str(input_path), str(tmp_path / "archived"), workers=2, archive=True) == (0, 3)
+    records = [json.loads(line) for line in (tmp_path / "archived" / "manifest.jsonl").read_text().splitlines()]
+    assert sorted(r["error"] for r in records).count("archive: disk full") == 2
+
+def test_request_timing_observed_once_per_request():
+    def count():
+        return sample_value("request_processing_duration_seconds_count")
+
+    def instrumentator_count():
+        return sample_value("http_request_duration_seconds_count", {"handler": "/generate-pdf", "method": "POST"})
+
+    before, instrumentator_before = count(), instrumentator_count()
+    client.get("/health")
+    client.post("/generate-pdf", content=b"invalid json", headers={"Content-Type": "application/json"})
+    # Оба histogram получают один и тот же замер; служебные эндпоинты не учитываются
+    assert count() - before == 1
+    assert instrumentator_count() - instrumentator_before == 1
+
+def test_generate_pdf_deadline_aborts_between_stages(monkeypatch):
+
+    stages = []
+    exit_state = []
+    def slow_build_pdf(json_data, temp_dir, request_id, converter=None, optimize=False):
+        try:
+            for _ in range(50):
+                with app_module.pipeline_stage("render"):
+                    stages.append(temp_dir)
+                    time.sleep(0.02)
+            raise AssertionError("build should have been aborted")
+        finally:
+            # При выходе потока слот еще занят, а временная директория не удалена
+            exit_state.append((
+                converter not in app_module.conversion_scheduler._free_converters,
+                os.path.exists(temp_dir),
+            ))
+
+    monkeypatch.setattr(app_module, "build_pdf", slow_build_pdf)
+    before = sample_value("pdf_requests_cancelled_total", {"reason": "deadline", "stage": "render"})
+
+    response = client.post(
+        "/generate-pdf",
+        content=json.dumps({"id": "39-24"}),
+        headers={"Content-Type": "application/json", "X-Request-Timeout": "0.2"}
+    )
+    assert response.status_code == 504
+    assert len(stages) < 50
+    assert exit_state == [(True, True)]
+    # Временная директория удалена
+    assert not os.path.exists(stages[0])
+    after = sample_value("pdf_requests_cancelled_total", {"reason": "deadline", "stage": "render"})
+    assert after - before == 1
+
+@pytest.mark.skipif(os.name != "posix", reason="requires POSIX process groups")
+def test_run_libreoffice_killed_on_cancel():
+    from app import CancellationToken, RequestCancelled, current_cancellation, run_libreoffice
+
+    cancellation = CancellationToken()
+    token = current_cancellation.set(cancellation)
+    threading.Timer(0.2, cancellation.cancel, args=("disconnect",)).start()
+    started = time.perf_counter()
+    try:
+        with pytest.raises(RequestCancelled):
+            run_libreoffice(["sh", "-c", "sleep 30"], os.getcwd(), os.environ.copy(), timeout=60)
+    finally:
+        current_cancellation.reset(token)
+    assert time.perf_counter() - started < 5
+
+def test_incremental_build_reuses_unchanged_segments(tmp_path, monkeypatch, incremental_build):
+    converted = incremental_build.converted
+    items = [{"invNumber": f"INV-{i}", "name": f"Item {i}", "informationDate": "2024", "id": str(i)} for i in range(12)]
+    data = dict(
+        registry_application("app-1", items),
+        applicantType="INDIVIDUAL",
+        individualInfo={"name": "Test", "esia": "1"},
+    )
+    assert app_module.incremental_applicable(data)
+
+    pdf_path = build_in(tmp_path / "first", data)
+    assert sorted(converted) == ["cover.docx", "segment_00000.docx", "segment_00001.docx", "segment_00002.docx"]
+    assert len(PdfReader(pdf_path).pages) == 4
+
+    # Изменение одной строки во втором сегменте: перегенерируются только он и титульный лист
+    converted.clear()
+    items = [dict(item) for item in items]
+    items[7]["name"] = "Changed"
+    pdf_path = build_in(tmp_path / "second", dict(data, operation="UPDATE", registryItems=items))
+    assert sorted(converted) == ["cover.docx", "segment_00001.docx"]
+    assert len(PdfReader(pdf_path).pages) == 4
+
+    # Номера строк сегмента продолжают нумерацию реестра
+    from docx import Document
+    segment = Document(str(tmp_path / "second" / "segment_00001.docx"))
+    numbers = [row.cells[0].text for row in segment.tables[0].rows[1:]]
+    assert numbers == ["6", "7", "8", "9", "10"]
+
+    # После изменения шаблона сегменты старого шаблона не используются
+    template = tmp_path / "template.docx"
+    shutil.copy("templates/template.docx", template)
+    with zipfile.ZipFile(template, "a") as archive:
+        archive.writestr("customXml/revision.xml", "<revision>2</revision>")
+    monkeypatch.setattr(app_module, "TEMPLATE_PATH", str(template))
+    converted.clear()
+    build_in(tmp_path / "third", dict(data, operation="UPDATE", registryItems=items))
+    assert sorted(converted) == ["cover.docx", "segment_00000.docx", "segment_00001.docx", "segment_00002.docx"]
+
+def test_conversion_supervisor_hedges_slow_conversion(tmp_path, monkeypatch):
+    from app import CircuitBreaker, ConversionLatency, ConversionSupervisor, current_cancellation
+
+    started = []
+
+    def fake_attempt(input_docx_list, output_dir, converter, timeout):
+        started.append(converter)
+        if converter == 0:
+            # Зависший основной процесс, завершается только отменой
+            cancellation = current_cancellation.get()
+            while not cancellation.cancelled():
+                time.sleep(0.01)
+            time.sleep(0.1)
+            started.append("primary_exited")
+            raise app_module.RequestCancelled(cancellation.reason, None)
+        with open(os.path.join(output_dir, "output.pdf"), "wb") as f:
+            f.write(b"%PDF-1.4")
+
+    monkeypatch.setattr(app_module, "run_conversion_attempt", fake_attempt)
+    latency = ConversionLatency()
+    latency.observe(0, 0.05)
+    supervisor = ConversionSupervisor(
+        CircuitBreaker(5, 30), latency, hedge_min_delay=0.05, hedge_min_samples=1
+    )
+    docx = tmp_path / "output.docx"
+    docx.write_bytes(b"")
+
+    before = sample_value("conversion_hedges_total", {"result": "hedge_won"})
+    supervisor.run([str(docx)], str(tmp_path), 0, timeout=10)
+    after = sample_value("conversion_hedges_total", {"result": "hedge_won"})
+
+    # Проигравший процесс остановлен до освобождения слота
+    assert started == [0, "hedge_0", "primary_exited"]
+    assert (tmp_path / "output.pdf").read_bytes() == b"%PDF-1.4"
+    assert after - before == 1
+
+def test_conversion_retry_and_circuit_breaker(tmp_path, monkeypatch):
+    from app import CircuitBreaker, ConversionFailed, ConversionLatency, ConversionSupervisor, ConverterUnavailable
+
+    calls = []
+
+    def fake_attempt(input_docx_list, output_dir, converter, timeout):
+        calls.append(converter)
+        if len(calls) != 2:
+            raise ConversionFailed("soffice crashed", "error")
+        with open(os.path.join(output_dir, "output.pdf"), "wb") as f:
+            f.write(b"%PDF-1.4")
+
+    monkeypatch.setattr(app_module, "run_conversion_attempt", fake_attempt)
+    supervisor = ConversionSupervisor(CircuitBreaker(1, 30), ConversionLatency(), hedge_enabled=False)
+    docx = tmp_path / "output.docx"
+    docx.write_bytes(b"")
+
+    # Первый сбой повторяется на новом экземпляре
+    supervisor.run([str(docx)], str(tmp_path), 0, timeout=10)
+    assert calls == [0, 0]
+
+    # Сбой и повтора размыкает выключатель, следующие конвертации отклоняются сразу
+    with pytest.raises(ConversionFailed):
+        supervisor.run([str(docx)], str(tmp_path), 0, timeout=10)
+    assert supervisor.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(ConverterUnavailable):
+        supervisor.run([str(docx)], str(tmp_path), 0, timeout=10)
+    assert len(calls) == 4
+
+    monkeypatch.setattr(app_module, "conversion_supervisor", supervisor)
+    response = client.post("/generate-pdf", json={"id": "test-id", "registryItems": []})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
+    assert client.get("/ready").json()["circuit"] == "open"
+
+def test_incremental_build_multipage_segments(tmp_path, incremental_build):
+    converted = incremental_build.converted
+    incremental_build.segment_pages = 3
+    items = [{"invNumber": f"INV-{i}", "name": f"Item {i}", "id": str(i)} for i in range(50)]
+    data = registry_application("app-2", items)
+    reused = sample_value("pdf_incremental_segments_total", {"result": "reused"})
+
+    pdf_path = build_in(tmp_path / "first", data)
+    assert len(PdfReader(pdf_path).pages) == 1 + 10 * 3
+    # Все сегменты по одному разу и повторно те, у которых сдвинулась первая страница
+    assert len([name for name in converted if name.startswith("segment")]) == 10 + 9
+
+    # Повторная отправка той же версии переиспользует все сегменты
+    converted.clear()
+    pdf_path = build_in(tmp_path / "second", dict(data, operation="UPDATE"))
+    assert converted == ["cover.docx"]
+    assert len(PdfReader(pdf_path).pages) == 31
+    after = sample_value("pdf_incremental_segments_total", {"result": "reused"})
+    assert after - reused == 10
+
+def test_disabled_circuit_breaker_never_opens(monkeypatch):
+    from app import CircuitBreaker, ConversionLatency, ConversionSupervisor
+
+    breaker = CircuitBreaker(0, 30)
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert sample_value("conversion_circuit_state") == 0
+
+    monkeypatch.setattr(app_module, "conversion_supervisor", ConversionSupervisor(breaker, ConversionLatency()))
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["circuit"] == "closed"